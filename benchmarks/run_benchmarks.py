@@ -0,0 +1,222 @@
+'''
+Time each stage of the curation scripts against a synthetic study
+(see synthetic_data.py), recording wall and CPU time, throughput and
+peak memory:
+
+    python benchmarks/run_benchmarks.py --root /tmp/pddb2 --generate \
+            --subjects 4 --hours 2 --out benchmarks.json
+
+Parsing is timed for the untyped read_csv the scripts used to do and for
+the typed load path, with float64 and float32 channels; frame_mb is the
+memory of the parsed frames.
+
+Peak memory is measured with tracemalloc in a second run of each stage,
+so that tracing does not distort the timings. Pass --no-memory to skip it.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import tracemalloc
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sensor_io
+import storage_backend
+import window_serialization
+import curation_pipeline
+import curate_clinic_motor_tasks as clinic
+import curate_at_home_motor_tasks as at_home
+import synthetic_data
+
+
+def read_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", required=True,
+            help="Local backend directory holding the synthetic study.")
+    parser.add_argument("--generate", action="store_const",
+            const=True, default = False,
+            help="(Re)generate the synthetic study before benchmarking.")
+    parser.add_argument("--subjects", type=int, default=2)
+    parser.add_argument("--hours", type=float, default=1)
+    parser.add_argument("--sampling-rate", type=float, default=50)
+    parser.add_argument("--locations", type=int, default=3)
+    parser.add_argument("--chunksize", type=int, default=100000,
+            help="Chunk size of the streaming slicing benchmark.")
+    parser.add_argument("--no-memory", action="store_const",
+            const=True, default = False)
+    parser.add_argument("--out", default=None,
+            help="Write the results to this JSON file.")
+    args = parser.parse_args()
+    return(args)
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(stage, func, unit, measure_memory=True):
+    """
+    Run `func`, which returns the number of `unit`s it processed and
+    optionally the number of bytes it read or wrote.
+
+    Returns
+    -------
+    dict of results
+    """
+    wall, cpu = time.perf_counter(), time.process_time()
+    items = func()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    items, n_bytes = items if isinstance(items, tuple) else (items, None)
+    result = {"stage": stage,
+              "wall_seconds": wall,
+              "cpu_seconds": cpu,
+              "items": items,
+              "unit": unit,
+              "items_per_second": items / wall if wall else None,
+              "bytes": n_bytes,
+              "mb_per_second": n_bytes / 2**20 / wall if n_bytes and wall else None}
+    if measure_memory:
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["peak_traced_mb"] = peak / 2**20
+    result["max_rss_mb"] = max_rss_mb()
+    return result
+
+
+def untyped_parse(path):
+    """
+    Parse a sensor file the way it was before typed loading, as a baseline.
+    """
+    sensor_measurement = pd.read_csv(path)
+    sensor_measurement.Timestamp = pd.to_datetime(sensor_measurement.Timestamp)
+    sensor_measurement.set_index("Timestamp", drop = True, inplace=True)
+    sensor_measurement.sort_index(inplace=True)
+    return sensor_measurement
+
+
+def frame_mb(df):
+    return df.memory_usage(index=True, deep=True).sum() / 2**20
+
+
+def run_benchmarks(backend, chunksize, measure_memory=True):
+    results = []
+    run = lambda stage, func, unit: results.append(
+            measure(stage, func, unit, measure_memory))
+
+    raw_scores = clinic.read_syn_table(backend, clinic.SCORES)
+    run("clean_scores",
+        lambda: len(clinic.clean_scores(raw_scores.copy())), "scores")
+    scores = clinic.clean_scores(raw_scores)
+    raw_diary = at_home.read_syn_table(backend, at_home.DIARY)
+    run("read_diary",
+        lambda: (at_home.read_diary(backend), len(raw_diary))[1],
+        "diary entries")
+    diary = at_home.read_diary(backend)
+
+    listings = {}
+    for col, parent, filtering_prefix, sensor in clinic.SENSOR_STREAMS:
+        listings.setdefault(parent, (sensor, []))[1].extend(
+                (fname, sensor) for fname, _ in backend.list_children(parent)
+                if fname.startswith(filtering_prefix))
+    files = [f for _, fs in listings.values() for f in fs]
+    def find_relevant_scores():
+        scores_index = clinic.index_scores(scores)
+        for fname, sensor in files:
+            clinic.find_relevant_scores(fname, scores, sensor, scores_index)
+        return len(files)
+    run("find_relevant_scores", find_relevant_scores, "files")
+
+    curation = clinic.sensor_curation(scores)
+    work = curation_pipeline.plan_sensor_work(backend, curation)
+    downloaded = [(sensor, {col: backend.get(files[col]) for col in files},
+                   task_ids) for sensor, files, task_ids in work]
+    source_bytes = sum(os.path.getsize(f.path)
+                       for _, fs, _ in downloaded for f in fs.values())
+    paths = [f.path for _, fs, _ in downloaded for f in fs.values()]
+    parsers = [
+        ("parse (untyped)", untyped_parse),
+        ("parse (typed)", sensor_io.parse_sensor_measurement),
+        ("parse (typed, float32)",
+         lambda path: sensor_io.parse_sensor_measurement(path, "float32"))]
+    for stage, parse in parsers:
+        run(stage,
+            lambda: (sum(len(parse(path)) for path in paths), source_bytes),
+            "rows")
+        results[-1]["frame_mb"] = sum(frame_mb(parse(path)) for path in paths)
+    def slice_all(windows, chunksize=None, cache=None):
+        sliced = []
+        for sensor, fs, ids in downloaded:
+            sliced.append({col: curation_pipeline.slice_sensor_measurement(
+                               fs[col], windows, ids, sensor, chunksize, cache)
+                           for col in fs})
+        return sliced
+    count_windows = lambda sliced: sum(len(s[col]) for s in sliced for col in s)
+    run("slice_sensor_measurement",
+        lambda: (count_windows(slice_all(curation.windows)), source_bytes),
+        "windows")
+    run("slice_sensor_measurement (streaming)",
+        lambda: (count_windows(slice_all(curation.windows, chunksize)),
+                 source_bytes),
+        "windows")
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = sensor_io.SensorCache(cache_dir)
+        slice_all(curation.windows, cache=cache)
+        run("slice_sensor_measurement (cached)",
+            lambda: (count_windows(slice_all(curation.windows, cache=cache)),
+                     source_bytes),
+            "windows")
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    at_home_curation = at_home.sensor_curation(diary)
+    at_home_work = curation_pipeline.plan_sensor_work(backend, at_home_curation)
+    run("slice_sensor_measurement (diary)",
+        lambda: sum(len(curation_pipeline.slice_sensor_measurement(
+                        backend.get(files[col]), at_home_curation.windows,
+                        ids, sensor))
+                    for sensor, files, ids in at_home_work for col in files),
+        "windows")
+
+    sliced = slice_all(curation.windows)
+    windows = [d for s in sliced for col in s for d in s[col].sensor_data]
+    for compression in [None, "gzip"]:
+        run("window serialization ({})".format(compression or "csv"),
+            lambda: (len(windows), sum(
+                len(window_serialization.serialize_window(d, compression))
+                for d in windows)),
+            "windows")
+    run("merge",
+        lambda: sum(len(curation_pipeline.join_modalities(s)) for s in sliced),
+        "windows")
+    return results
+
+
+def main():
+    args = read_args()
+    if args.generate:
+        shutil.rmtree(args.root, ignore_errors=True)
+        synthetic_data.generate(
+                args.root, subjects=args.subjects, hours=args.hours,
+                sampling_rate=args.sampling_rate, locations=args.locations)
+    backend = storage_backend.LocalBackend(args.root)
+    results = run_benchmarks(backend, args.chunksize,
+                             measure_memory=not args.no_memory)
+    for r in results:
+        print("{:<42} {:>9.3f}s {:>12.1f} {}/s".format(
+            r["stage"], r["wall_seconds"], r["items_per_second"] or 0, r["unit"]))
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
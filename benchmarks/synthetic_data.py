@@ -0,0 +1,172 @@
+'''
+Generate a synthetic study in the layout of a `storage_backend.LocalBackend`,
+so that the curation scripts and benchmarks can run without Synapse:
+
+    python benchmarks/synthetic_data.py --root /tmp/pddb2 --subjects 4 --hours 2
+
+MC10 files (Table9A/B/C, one per subject, several body locations) and
+smartwatch files (Table8, one per subject and month) are written under the
+folder ids the curation scripts read from, alongside matching clinic
+scores and at-home diary tables.
+'''
+
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import storage_backend
+import curate_clinic_motor_tasks as clinic
+import curate_at_home_motor_tasks as at_home
+
+MC10_TABLES = ["Table9A", "Table9B", "Table9C"]
+MC10_LOCATIONS = ["anterior thigh left", "dorsal hand right",
+                  "medial chest", "flexor digitorum left"]
+DIARY_MEASUREMENTS = ["Activity Intensity", "Dyskinesia", "On/Off", "Tremor"]
+START = pd.Timestamp("2019-05-01 08:00:00")
+
+
+def read_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", required=True,
+            help="Directory to write the local backend to.")
+    parser.add_argument("--subjects", type=int, default=2)
+    parser.add_argument("--hours", type=float, default=1)
+    parser.add_argument("--sampling-rate", type=float, default=50,
+            help="Samples per second of every sensor stream.")
+    parser.add_argument("--locations", type=int, default=3,
+            help="Number of MC10 body locations per subject.")
+    parser.add_argument("--tasks-per-hour", type=int, default=20)
+    parser.add_argument("--diary-per-hour", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    return(args)
+
+
+def sensor_timestamps(hours, sampling_rate):
+    n = int(hours * 3600 * sampling_rate)
+    return START + pd.to_timedelta(np.arange(n) / sampling_rate, unit="s")
+
+
+def write_mc10(root, subject_id, hours, sampling_rate, n_locations, rng):
+    timestamps = sensor_timestamps(hours, sampling_rate)
+    folder = os.path.join(root, "folders", clinic.MC10_MEASUREMENTS)
+    os.makedirs(folder, exist_ok=True)
+    for table in MC10_TABLES:
+        measurements = []
+        for location in MC10_LOCATIONS[:n_locations]:
+            n = len(timestamps)
+            measurement = pd.DataFrame({
+                "Timestamp": timestamps,
+                "SubjID": subject_id,
+                "Location": location})
+            if table == "Table9C": # EMG
+                measurement["Value"] = rng.normal(size=n)
+            else:
+                for axis in ["X", "Y", "Z"]:
+                    measurement[axis] = rng.normal(size=n)
+            measurements.append(measurement)
+        # locations are recorded concurrently, interleave them in time
+        measurements = pd.concat(measurements).sort_values(
+                "Timestamp", kind="mergesort")
+        measurements.to_csv(os.path.join(
+            folder, "{}_{}.csv".format(table, subject_id)), index=False)
+
+
+def write_smartwatch(root, subject_id, hours, sampling_rate, rng):
+    timestamps = sensor_timestamps(hours, sampling_rate)
+    folder = os.path.join(root, "folders", clinic.SMARTWATCH_MEASUREMENTS)
+    os.makedirs(folder, exist_ok=True)
+    n = len(timestamps)
+    measurements = pd.DataFrame({
+        "Timestamp": timestamps,
+        "SubjID": subject_id,
+        "X": rng.normal(size=n),
+        "Y": rng.normal(size=n),
+        "Z": rng.normal(size=n)})
+    for month, monthly in measurements.groupby(
+            measurements.Timestamp.dt.strftime("%Y-%m")):
+        monthly.to_csv(os.path.join(
+            folder, "Table8_{}_{}.csv".format(subject_id, month)), index=False)
+
+
+def scores_table(subject_ids, hours, tasks_per_hour, rng):
+    n = int(hours * tasks_per_hour)
+    rows = []
+    for subject_id in subject_ids:
+        starts = START + pd.to_timedelta(
+                np.sort(rng.uniform(0, hours * 3600 - 60, n)), unit="s")
+        durations = pd.to_timedelta(rng.uniform(20, 60, n), unit="s")
+        for start, duration in zip(starts, durations):
+            task = rng.choice(list(clinic.TASK_CODE_MAP))
+            row = {"SubjID": subject_id,
+                   "Visit": "1",
+                   "Task": task,
+                   "TaskAbb": task,
+                   "Start Timestamp (UTC)": str(start),
+                   "Stop Timestamp (UTC)": str(start + duration)}
+            for score in ["Tremor - Left", "Tremor - Right",
+                          "Bradykinesia - Left", "Bradykinesia - Right",
+                          "Dyskinesia - Left", "Dyskinesia - Right",
+                          "Overall"]:
+                row[score] = int(rng.integers(0, 5))
+            row["Validated"] = 1
+            row["Side"] = rng.choice(["Left", "Right"])
+            rows.append(row)
+    return pd.DataFrame(rows, columns=list(clinic.SCORES_COL_MAP))
+
+
+def diary_table(subject_ids, hours, diary_per_hour, rng):
+    n = max(1, int(hours * diary_per_hour))
+    # keep diary windows inside the recording where possible
+    margin = min(at_home.DIARY_WINDOW.total_seconds(), hours * 3600 / 4)
+    rows = []
+    for subject_id in subject_ids:
+        timestamps = START + pd.to_timedelta(
+                np.sort(rng.uniform(margin, hours * 3600 - margin, n)), unit="s")
+        for timestamp in timestamps.floor("min"):
+            for measurement in DIARY_MEASUREMENTS:
+                reported = timestamp + pd.Timedelta(
+                        minutes=int(rng.integers(0, 30)))
+                rows.append({"SubjID": subject_id,
+                             "Timestamp": str(timestamp),
+                             "Reported Timestamp": str(reported),
+                             "Measurement Name": measurement,
+                             "Value": int(rng.integers(0, 5))})
+    return pd.DataFrame(rows, columns=list(at_home.DIARY_COL_MAP))
+
+
+def generate(root, subjects=2, hours=1, sampling_rate=50, locations=3,
+             tasks_per_hour=20, diary_per_hour=2, seed=0):
+    """
+    Write a synthetic study to `root`.
+
+    Returns
+    -------
+    a storage_backend.LocalBackend of `root`
+    """
+    rng = np.random.default_rng(seed)
+    backend = storage_backend.LocalBackend(root)
+    subject_ids = [1000 + i for i in range(subjects)]
+    for subject_id in subject_ids:
+        write_mc10(root, subject_id, hours, sampling_rate, locations, rng)
+        write_smartwatch(root, subject_id, hours, sampling_rate, rng)
+    scores_table(subject_ids, hours, tasks_per_hour, rng).to_csv(
+            os.path.join(root, "tables", clinic.SCORES + ".csv"), index=False)
+    diary_table(subject_ids, hours, diary_per_hour, rng).to_csv(
+            os.path.join(root, "tables", at_home.DIARY + ".csv"), index=False)
+    return backend
+
+
+def main():
+    args = read_args()
+    generate(args.root, subjects=args.subjects, hours=args.hours,
+             sampling_rate=args.sampling_rate, locations=args.locations,
+             tasks_per_hour=args.tasks_per_hour,
+             diary_per_hour=args.diary_per_hour, seed=args.seed)
+
+
+if __name__ == "__main__":
+    main()
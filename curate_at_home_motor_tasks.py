@@ -13,203 +13,121 @@ Motor Task Home Timestamps and Self-Reported Scores
     activity_intensity_reported_timestamp
 '''
 
-import os
 import uuid
 import argparse
-import tempfile
 import datetime
-import multiprocessing
-import synapseclient as sc
-import synapseutils as su
+import numpy as np
 import pandas as pd
+import storage_backend
+import curation_pipeline
+import curation_state
+import table_store
+import sharding
+import stage_metrics
 
 TESTING = False
 DIARY = "syn18435314"
 MC10_MEASUREMENTS = "syn18822536" if TESTING else "syn18435632"
 SMARTWATCH_MEASUREMENTS = "syn18822537" if TESTING else "syn18435623"
-SMARTWATCH_SENSOR_NAME = "smartwatch"
-MC10_SENSOR_NAME = "mc10"
+SMARTWATCH_SENSOR_NAME = curation_pipeline.SMARTWATCH_SENSOR_NAME
+MC10_SENSOR_NAME = curation_pipeline.MC10_SENSOR_NAME
+SENSOR_STREAMS = [ # column, parent, filtering prefix, sensor
+        ("mc10_accelerometer", MC10_MEASUREMENTS, "Table9A", MC10_SENSOR_NAME),
+        ("mc10_gyroscope", MC10_MEASUREMENTS, "Table9B", MC10_SENSOR_NAME),
+        ("mc10_emg", MC10_MEASUREMENTS, "Table9C", MC10_SENSOR_NAME),
+        ("smartwatch_accelerometer", SMARTWATCH_MEASUREMENTS, "Table8",
+         SMARTWATCH_SENSOR_NAME)]
 FRAC_TO_STORE = 0.1 if TESTING else 1
 TABLE_OUTPUT = "syn11611056" if TESTING else "syn18407520"
+DIARY_WINDOW = datetime.timedelta(minutes=10)
 DIARY_COL_MAP = {
         "SubjID": "subject_id",
         "Timestamp": "timestamp",
         "Reported Timestamp": "reported_timestamp",
         "Measurement Name": "measurement",
         "Value": "value"}
+DIARY_MEASUREMENT_MAP = {
+        "Activity Intensity": "activity_intensity",
+        "Dyskinesia": "dyskinesia",
+        "On/Off": "on_off",
+        "Tremor": "tremor"}
+MEASUREMENT_ID_NAMESPACE = uuid.uuid5(
+        uuid.NAMESPACE_URL, "https://www.synapse.org/#!Synapse:" + DIARY)
 
 
 def read_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--download-in-parallel", action="store_const",
-            const=True, default = False)
-    parser.add_argument("--upload-in-parallel", action="store_const",
-            const=True, default = False)
+    curation_pipeline.add_arguments(parser, FRAC_TO_STORE)
     args = parser.parse_args()
+    curation_pipeline.check_arguments(parser, args)
     return(args)
 
 
 def read_syn_table(syn, synapse_id, q = "select * from {}"):
-    q = syn.tableQuery(q.format(synapse_id))
-    df = q.asDataFrame()
+    df = syn.query_table(q.format(synapse_id))
     return df
 
 
-def parse_info_from_filename(fname, sensor):
-    if sensor == SMARTWATCH_SENSOR_NAME:
-        _, subject_id, year_month = os.path.splitext(fname)[0].split("_")
-        year, month = tuple(map(int, year_month.split("-")))
-    elif sensor == MC10_SENSOR_NAME:
-        subject_id = int(os.path.splitext(fname)[0].split("_")[1])
-        year, month = None, None
-    else:
-        raise TypeError("sensor must be one of {} or {}".format(
-            SMARTWATCH_SENSOR_NAME, MC10_SENSOR_NAME))
-    return subject_id, year, month
-
-
-def find_relevant_diary_entries(fname, diary, sensor):
-    def is_match(t, year, month, f_subject_id, diary_subject_id):
-        if int(f_subject_id) == int(diary_subject_id):
-            if year is None or month is None:
-                return True
-            elif isinstance(year, int) and isinstance(month, int):
-                return year == t.year and month == t.month
-            else:
-                raise TypeError("Year and month must both be integers.")
-        else:
-            return False
-    subject_id, year, month = parse_info_from_filename(fname, sensor)
-    relevent_entries = diary.apply(
-            lambda s : is_match(s.timestamp, year, month, subject_id, s.subject_id),
-            axis = 1)
-    return diary[relevent_entries]
-
-
-def new_data_column(syn, diary, col, parent, filtering_prefix, sensor,
-                    download_in_parallel):
-    relevant_entities = download_relevant_children(
-            syn, parent, filtering_prefix, diary, sensor, download_in_parallel)
-    all_sliced_measurements = pd.DataFrame()
-    for syn_id in relevant_entities:
-        f, measurement_ids = (relevant_entities[syn_id]["synapse_file"],
-                              relevant_entities[syn_id]["measurement_ids"])
-        sliced_measurements = slice_sensor_measurement(f, diary, measurement_ids, sensor)
-        sliced_measurements = sliced_measurements.rename(
-                {"sensor_data": col}, axis = 1)
-        relevant_entities[syn_id]["data"] = sliced_measurements
-    if len(relevant_entities):
-        all_sliced_measurements = pd.concat(
-                [relevant_entities[syn_id]["data"] for syn_id in relevant_entities],
-                axis=0)
-    return(all_sliced_measurements)
-
-
-def download_relevant_children(syn, parent, filtering_prefix, diary, sensor,
-                               download_in_parallel=False):
+def index_diary(diary):
     """
+    Group diary by subject and by (subject, year, month) of `timestamp`
+    so that matching a file against them is a single dictionary lookup.
+
     Returns
     -------
-    dict with key synapse_id (str) and values
-    synapse_file (File), measurement_ids (list)
+    dict with keys subject_id (int) or (subject_id, year, month) and
+    values the index labels of the matching diary
     """
-    _, _, entity_info = list(su.walk(syn, parent))[0]
-    entity_info = [(i, j) for i, j in entity_info if i.startswith(filtering_prefix)]
-    relevant_entities = {}
-    for fname, syn_id in entity_info:
-        relevant_entries = find_relevant_diary_entries(fname, diary, sensor)
-        if len(relevant_entries):
-            relevant_entities[syn_id] = {"synapse_file": None,
-                                         "measurement_ids": relevant_entries.measurement_id}
-    ordered_synapse_ids = list(relevant_entities.keys())
-    if download_in_parallel:
-        mp = multiprocessing.dummy.Pool(4)
-        children = mp.map(syn.get, ordered_synapse_ids)
+    subject_ids = diary.subject_id.astype(int)
+    diary_index = dict(diary.groupby(subject_ids).groups)
+    diary_index.update(diary.groupby(
+        [subject_ids, diary.timestamp.dt.year, diary.timestamp.dt.month]).groups)
+    return diary_index
+
+
+def find_relevant_diary_entries(fname, diary, sensor, diary_index=None):
+    if diary_index is None:
+        diary_index = index_diary(diary)
+    subject_id, year, month = curation_pipeline.parse_info_from_filename(
+            fname, sensor)
+    if year is None or month is None:
+        key = int(subject_id)
+    elif isinstance(year, int) and isinstance(month, int):
+        key = (int(subject_id), year, month)
     else:
-        children = list(map(syn.get, ordered_synapse_ids))
-    for syn_id, f in zip(ordered_synapse_ids, children):
-        relevant_entities[syn_id]["synapse_file"] = f
-    return relevant_entities
+        raise TypeError("Year and month must both be integers.")
+    if key not in diary_index:
+        return diary.iloc[:0]
+    return diary.loc[diary_index[key]]
 
 
-def slice_from_diary(sensor_measurement, diary_entry, sensor):
+def sensor_curation(diary):
     """
     Returns
     -------
-    a pandas DataFrame with columns location and sensor_data
+    the curation_pipeline.SensorCuration of the windows of `DIARY_WINDOW`
+    around each entry of `diary`
     """
-    result = pd.DataFrame(columns = ["sensor_location", "sensor_data"])
-    ten_minutes = datetime.timedelta(minutes=10)
-    start, stop = (diary_entry.loc["timestamp"] - ten_minutes,
-                   diary_entry.loc["timestamp"] + ten_minutes)
-    relevant_range = sensor_measurement[start:stop]
-    if len(relevant_range) == 0:
-        pass
-    elif sensor == "mc10":
-        for location in relevant_range.Location.unique():
-            local_range = relevant_range.query("Location == @location")
-            local_range = local_range.drop(["SubjID", "Location"], axis = 1)
-            local_range = local_range.reset_index(drop=False)
-            time_zero = local_range.Timestamp.iloc[0]
-            local_range.Timestamp = local_range.Timestamp - time_zero
-            local_range.Timestamp = local_range.Timestamp.apply(
-                    lambda td : td.total_seconds())
-            location = "_".join(location.split())
-            result = result.append({"sensor_location": location,
-                                    "sensor_data": local_range},
-                                   ignore_index=True)
-    elif sensor == "smartwatch":
-        local_range = relevant_range.drop(["SubjID"], axis = 1)
-        local_range = local_range.reset_index(drop=False)
-        time_zero = local_range.Timestamp.iloc[0]
-        time_end = local_range.Timestamp.iloc[-1]
-        local_range.Timestamp = local_range.Timestamp - time_zero
-        local_range.Timestamp = local_range.Timestamp.apply(
-                lambda td : td.total_seconds())
-        result = result.append({"sensor_location": None,
-                                "sensor_data": local_range},
-                               ignore_index=True)
-    result.index = pd.Index([diary_entry.measurement_id] * len(result))
-    return result
-
-
-def slice_sensor_measurement(f, diary, relevant_measurement_ids, sensor):
-    sensor_measurement = pd.read_csv(f.path)
-    sensor_measurement.Timestamp = pd.to_datetime(sensor_measurement.Timestamp)
-    sensor_measurement.set_index("Timestamp", drop=True, inplace=True)
-    sensor_measurement.sort_index(inplace=True)
-    relevant_diary_entries = diary.loc[relevant_measurement_ids]
-    measurements = relevant_diary_entries.apply(
-            lambda diary_entry : slice_from_diary(sensor_measurement, diary_entry, sensor),
-            axis = 1)
-    measurements = pd.concat(measurements.values, axis=0)
-    return(measurements)
-
-
-def replace_cols_with_filehandles(syn, df, cols, upload_in_parallel):
-    if upload_in_parallel:
-        mp = multiprocessing.dummy.Pool(4)
-        for col in cols:
-            df.loc[:,col] = list(mp.map(
-                    lambda df_ : replace_dataframe_with_filehandle(syn, df_),
-                    df[col]))
-    else:
-        for col in cols:
-            df.loc[:,col] = list(map(
-                    lambda df_ : replace_dataframe_with_filehandle(syn, df_),
-                    df[col]))
-
-
-def replace_dataframe_with_filehandle(syn, df):
-    if isinstance(df, pd.DataFrame):
-        f = tempfile.NamedTemporaryFile(suffix=".csv")
-        df.to_csv(f.name, index=False)
-        syn_f = syn.uploadSynapseManagedFileHandle(
-                f.name, mimetype="text/csv")
-        f.close()
-        return syn_f["id"]
-    else:
-        return ""
+    windows = pd.DataFrame({
+            "subject_id": diary.subject_id,
+            "start": diary.timestamp - DIARY_WINDOW,
+            "stop": diary.timestamp + DIARY_WINDOW}, index=diary.index)
+    diary_index = index_diary(diary)
+    def relevant_windows(fname, sensor):
+        return find_relevant_diary_entries(
+                fname, diary, sensor, diary_index).measurement_id
+    return curation_pipeline.SensorCuration(
+            windows, "measurement_id", SENSOR_STREAMS, relevant_windows)
+
+
+def measurement_id(subject_id, timestamp):
+    """
+    Returns
+    -------
+    a uuid (str) which is the same for the same diary entry in every run
+    """
+    return str(uuid.uuid5(MEASUREMENT_ID_NAMESPACE, "{}|{}".format(
+        subject_id, pd.Timestamp(timestamp).isoformat())))
 
 
 def read_diary(syn):
@@ -221,176 +139,191 @@ def read_diary(syn):
             ["subject_id", "timestamp", "measurement", "reported_timestamp"])
     diary = diary.drop_duplicates( # only keep most recently inputted metric value
             ["subject_id", "timestamp", "measurement"], keep="last")
+    # entries without a subject or timestamp can't be given an id
+    diary = diary.dropna(subset=["subject_id", "timestamp"])
     grouped_diary = diary.groupby(["subject_id", "timestamp"])
-    def assign_measurement_id(group):
-        group["measurement_id"] = str(uuid.uuid4())
-        return group
-    diary_with_id = grouped_diary.apply(assign_measurement_id)
-    reshaped_diary_measurements = diary_with_id.pivot(
+    # ngroup numbers the groups in the order of grouped_diary.size()
+    ids = np.array([measurement_id(subject_id, timestamp)
+                    for subject_id, timestamp in grouped_diary.size().index],
+                   dtype=object)
+    diary["measurement_id"] = ids[grouped_diary.ngroup().to_numpy()]
+    # pivoting each column separately keeps its dtype
+    reshaped_diary_measurements = diary.pivot(
             index="measurement_id", columns="measurement", values="value")
-    reshaped_diary_reported_timestamp = diary_with_id.pivot(
-            index="measurement_id", columns="measurement", values="reported_timestamp")
-    diary_with_id_col_subset = diary_with_id.drop(
+    reshaped_diary_measurements.columns = [
+            DIARY_MEASUREMENT_MAP[measurement]
+            for measurement in reshaped_diary_measurements.columns]
+    reshaped_diary_reported_timestamp = diary.pivot(
+            index="measurement_id", columns="measurement",
+            values="reported_timestamp")
+    reshaped_diary_reported_timestamp.columns = [
+            DIARY_MEASUREMENT_MAP[measurement] + "_reported_timestamp"
+            for measurement in reshaped_diary_reported_timestamp.columns]
+    diary_entries = diary.drop_duplicates(["subject_id", "timestamp"])
+    diary_entries = diary_entries.drop(
             ["measurement", "value", "reported_timestamp"], axis=1)
-    diary_with_id_col_subset = diary_with_id_col_subset.set_index(
-            "measurement_id", drop=False)
-    diary_with_id_col_subset = diary_with_id_col_subset.drop_duplicates(
-            ["subject_id", "timestamp"])
-    reshaped_diary_measurements = reshaped_diary_measurements.rename({
-        "Activity Intensity": "activity_intensity",
-        "Dyskinesia": "dyskinesia",
-        "On/Off": "on_off",
-        "Tremor": "tremor"}, axis=1)
-    reshaped_diary_reported_timestamp = reshaped_diary_reported_timestamp.rename({
-        "Activity Intensity": "activity_intensity_reported_timestamp",
-        "Dyskinesia": "dyskinesia_reported_timestamp",
-        "On/Off": "on_off_reported_timestamp",
-        "Tremor": "tremor_reported_timestamp"}, axis=1)
-    final_diary = diary_with_id_col_subset.join(reshaped_diary_measurements)
+    diary_entries = diary_entries.set_index("measurement_id", drop=False)
+    final_diary = diary_entries.join(reshaped_diary_measurements)
     final_diary = final_diary.join(reshaped_diary_reported_timestamp)
     return(final_diary)
 
 
-def move_index_to_column(df):
-    df.reset_index(drop=False, inplace=True)
-    df.rename({"index": "measurement_id"}, axis=1, inplace=True)
-
-
-def create_cols(table_type, syn=None):
+def create_cols(table_type, syn=None, packed=False):
     if table_type == MC10_SENSOR_NAME:
-        cols = [sc.Column(name="measurement_id", columnType="STRING"),
-                sc.Column(name="sensor_location", columnType="STRING"),
-                sc.Column(name="mc10_accelerometer", columnType="FILEHANDLEID"),
-                sc.Column(name="mc10_gyroscope", columnType="FILEHANDLEID"),
-                sc.Column(name="mc10_emg", columnType="FILEHANDLEID")]
+        cols = [{"name": "measurement_id", "columnType": "STRING"},
+                {"name": "sensor_location", "columnType": "STRING"},
+                {"name": "mc10_accelerometer", "columnType": "FILEHANDLEID"},
+                {"name": "mc10_gyroscope", "columnType": "FILEHANDLEID"},
+                {"name": "mc10_emg", "columnType": "FILEHANDLEID"}]
     elif table_type == SMARTWATCH_SENSOR_NAME:
-        cols = [sc.Column(name="measurement_id", columnType="STRING"),
-                sc.Column(name="smartwatch_accelerometer", columnType="FILEHANDLEID")]
+        cols = [{"name": "measurement_id", "columnType": "STRING"},
+                {"name": "smartwatch_accelerometer", "columnType": "FILEHANDLEID"}]
     elif table_type == "diary":
-        cols = list(syn.getTableColumns(DIARY))
-        cols = [sc.Column(name="measurement_id", columnType="STRING"),
-                sc.Column(name="subject_id", columnType="INTEGER"),
-                sc.Column(name="timestamp", columnType="DATE"),
-                sc.Column(name="activity_intensity", columnType="INTEGER"),
-                sc.Column(name="dyskinesia", columnType="INTEGER"),
-                sc.Column(name="on_off", columnType="INTEGER"),
-                sc.Column(name="tremor", columnType="INTEGER"),
-                sc.Column(name="activity_intensity_reported_timestamp", columnType="DATE"),
-                sc.Column(name="dyskinesia_reported_timestamp", columnType="DATE"),
-                sc.Column(name="on_off_reported_timestamp", columnType="DATE"),
-                sc.Column(name="tremor_reported_timestamp", columnType="DATE")]
+        cols = list(syn.get_table_columns(DIARY))
+        cols = [{"name": "measurement_id", "columnType": "STRING"},
+                {"name": "subject_id", "columnType": "INTEGER"},
+                {"name": "timestamp", "columnType": "DATE"},
+                {"name": "activity_intensity", "columnType": "INTEGER"},
+                {"name": "dyskinesia", "columnType": "INTEGER"},
+                {"name": "on_off", "columnType": "INTEGER"},
+                {"name": "tremor", "columnType": "INTEGER"},
+                {"name": "activity_intensity_reported_timestamp", "columnType": "DATE"},
+                {"name": "dyskinesia_reported_timestamp", "columnType": "DATE"},
+                {"name": "on_off_reported_timestamp", "columnType": "DATE"},
+                {"name": "tremor_reported_timestamp", "columnType": "DATE"}]
+    elif table_type == "features":
+        cols = [{"name": "measurement_id", "columnType": "STRING"},
+                {"name": "sensor", "columnType": "STRING"},
+                {"name": "sensor_location", "columnType": "STRING"},
+                {"name": "epoch", "columnType": "INTEGER"},
+                {"name": "epoch_start", "columnType": "DOUBLE"},
+                {"name": "activity_index", "columnType": "DOUBLE"},
+                {"name": "tremor_power", "columnType": "DOUBLE"},
+                {"name": "total_power", "columnType": "DOUBLE"},
+                {"name": "tremor_power_ratio", "columnType": "DOUBLE"},
+                {"name": "dominant_frequency", "columnType": "DOUBLE"}]
     else:
-        raise TypeError("table_type must be one of [{}, {}, {}]".format(
-            MC10_SENSOR_NAME, SMARTWATCH_SENSOR_NAME, "diary"))
+        raise TypeError("table_type must be one of [{}, {}, {}, {}]".format(
+            MC10_SENSOR_NAME, SMARTWATCH_SENSOR_NAME, "diary", "features"))
+    if packed: # sensor tables of --packed windows
+        cols.append({"name": "window_offset", "columnType": "INTEGER"})
     return cols
 
 
-def store_dataframe_to_synapse(syn, df, parent, name, cols):
-    df = df[[c['name'] for c in cols]]
-    schema = sc.Schema(name = name, columns = cols, parent = parent)
-    table = sc.Table(schema, df)
-    table = syn.store(table)
-    return table
-
-
 def main():
     args = read_args()
-    syn = sc.login()
-    diary = read_diary(syn)
-
-    # curate dataframes containing respective data measurements
-    mc10_accelerometer = new_data_column(
-            syn,
-            diary = diary,
-            col = "mc10_accelerometer",
-            parent = MC10_MEASUREMENTS,
-            filtering_prefix = "Table9A",
-            sensor = "mc10",
-            download_in_parallel = args.download_in_parallel)
-    mc10_gyroscope = new_data_column(
-            syn,
-            diary = diary,
-            col = "mc10_gyroscope",
-            parent = MC10_MEASUREMENTS,
-            filtering_prefix = "Table9B",
-            sensor = "mc10",
-            download_in_parallel = args.download_in_parallel)
-    mc10_emg = new_data_column(
-            syn,
-            diary = diary,
-            col = "mc10_emg",
-            parent = MC10_MEASUREMENTS,
-            filtering_prefix = "Table9C",
-            sensor = "mc10",
-            download_in_parallel = args.download_in_parallel)
-    smartwatch_accelerometer = new_data_column(
-            syn,
-            diary = diary,
-            col = "smartwatch_accelerometer",
-            parent = SMARTWATCH_MEASUREMENTS,
-            filtering_prefix = "Table8",
-            sensor = "smartwatch",
-            download_in_parallel = args.download_in_parallel)
-    smartwatch_accelerometer = smartwatch_accelerometer.drop(
-            "sensor_location", axis=1)
-
-    # move measurement_id from index to column
-    for df in [mc10_accelerometer, mc10_gyroscope,
-               mc10_emg, smartwatch_accelerometer]:
-        move_index_to_column(df)
-
-    # combine mc10 measurements into a single file
-    merged_mc10 = pd.DataFrame()
-    if len(mc10_accelerometer) and len(mc10_gyroscope):
-        merged_mc10 = mc10_accelerometer.merge(mc10_gyroscope, how="outer")
-    if len(merged_mc10) and len(mc10_emg):
-        merged_mc10 = merged_mc10.merge(mc10_emg, how="outer")
-
-    # shuffle records so that file handle integer contains no useful information
-    shuffled_mc10 = merged_mc10.sample(frac=FRAC_TO_STORE)
-    shuffled_smartwatch = smartwatch_accelerometer.sample(frac=FRAC_TO_STORE)
-
-    # replace the dataframes with file handles
-    replace_cols_with_filehandles( # replaces in-place
-            syn,
-            df = shuffled_mc10,
-            cols = ["mc10_accelerometer", "mc10_gyroscope", "mc10_emg"],
-            upload_in_parallel = args.upload_in_parallel)
-    replace_cols_with_filehandles( # replaces in-place
-            syn,
-            df = shuffled_smartwatch,
-            cols = ["smartwatch_accelerometer"],
-            upload_in_parallel = args.upload_in_parallel)
-
-    # make the dataframes look pretty
-    shuffled_mc10.sort_values(["measurement_id", "sensor_location"], inplace=True)
-    shuffled_smartwatch.sort_values("measurement_id", inplace=True)
-
-    # backup in case we just created a bajillion file handles but
-    # are rejected during table store
-    shuffled_mc10.to_csv("mc10_backup.csv", index=False)
-    shuffled_smartwatch.to_csv("smartwatch_backup.csv", index=False)
-    diary.to_csv("diary_backup.csv", index=False)
-
-    # store to synapse
-    shuffled_mc10_table = store_dataframe_to_synapse(
-            syn,
-            df = shuffled_mc10,
-            parent = TABLE_OUTPUT,
-            name = "MC10 Home Sensor Measurements",
-            cols = create_cols(MC10_SENSOR_NAME))
-    shuffled_smartwatch_table = store_dataframe_to_synapse(
-            syn,
-            df = shuffled_smartwatch,
-            parent = TABLE_OUTPUT,
-            name = "Smartwatch Home Sensor Measurements",
-            cols = create_cols(SMARTWATCH_SENSOR_NAME))
-    diary_table = store_dataframe_to_synapse(
-            syn,
-            df = diary,
-            parent = TABLE_OUTPUT,
-            name = "Motor Task Home Timestamps and Self-Reported Scores",
-            cols = create_cols("diary", syn=syn))
+    metrics = stage_metrics.StageMetrics(
+            profile = args.profile,
+            trace_memory = args.trace_memory,
+            progress = args.progress)
+    try:
+        syn = storage_backend.login(args.local_backend)
+        cache = curation_pipeline.sensor_cache(args)
+        state = None
+        if args.incremental is not None:
+            state = curation_state.CurationState(args.incremental)
+        if args.merge:
+            with metrics.stage("read_shards") as counts:
+                names = ["mc10_home", "smartwatch_home", "diary"]
+                if args.features:
+                    names.append("features_home")
+                tables = sharding.read_shards(args.shard_dir, names)
+                shuffled_mc10, shuffled_smartwatch, diary = tables[:3]
+                features = tables[3] if args.features else None
+                counts["rows"] = len(diary)
+        else:
+            with metrics.stage("read_diary") as counts:
+                diary = read_diary(syn)
+                if args.shard is not None:
+                    diary = diary[sharding.in_shard(diary.subject_id, args.shard)]
+                counts["rows"] = len(diary)
+
+            # curate dataframes containing respective file handles
+            tables = curation_pipeline.run_curation(
+                    syn, sensor_curation(diary), args, cache, metrics, state)
+            if tables is None: # only indexed or planned
+                return
+            shuffled_mc10, shuffled_smartwatch, features = tables
+            if args.shard is not None:
+                tables = {"mc10_home": shuffled_mc10,
+                          "smartwatch_home": shuffled_smartwatch,
+                          "diary": diary}
+                if features is not None:
+                    tables["features_home"] = features
+                sharding.write_shard(args.shard_dir, args.shard, tables)
+                return
+
+        # make the dataframes look pretty
+        shuffled_mc10.sort_values(["measurement_id", "sensor_location"], inplace=True)
+        shuffled_smartwatch.sort_values("measurement_id", inplace=True)
+        if features is not None:
+            features.sort_values(
+                    ["measurement_id", "sensor", "sensor_location", "epoch"],
+                    inplace=True)
+
+        # backup in case we just created a bajillion file handles but
+        # are rejected during table store
+        shuffled_mc10.to_csv("mc10_backup.csv", index=False)
+        shuffled_smartwatch.to_csv("smartwatch_backup.csv", index=False)
+        diary.to_csv("diary_backup.csv", index=False)
+        if features is not None:
+            features.to_csv("features_backup.csv", index=False)
+
+        # store to synapse
+        shuffled_mc10_table = table_store.store_dataframe(
+                syn,
+                df = shuffled_mc10,
+                parent = TABLE_OUTPUT,
+                name = "MC10 Home Sensor Measurements",
+                cols = create_cols(
+                        MC10_SENSOR_NAME,
+                        packed = "window_offset" in shuffled_mc10.columns),
+                metrics = metrics,
+                key_cols = ["measurement_id", "sensor_location"],
+                upsert = state is not None,
+                batch_size = args.store_batch_size,
+                threads = args.store_threads)
+        shuffled_smartwatch_table = table_store.store_dataframe(
+                syn,
+                df = shuffled_smartwatch,
+                parent = TABLE_OUTPUT,
+                name = "Smartwatch Home Sensor Measurements",
+                cols = create_cols(
+                        SMARTWATCH_SENSOR_NAME,
+                        packed = "window_offset" in shuffled_smartwatch.columns),
+                metrics = metrics,
+                key_cols = ["measurement_id"],
+                upsert = state is not None,
+                batch_size = args.store_batch_size,
+                threads = args.store_threads)
+        diary_cols = create_cols("diary", syn=syn)
+        diary_table = table_store.store_dataframe(
+                syn,
+                df = diary[[c["name"] for c in diary_cols]],
+                parent = TABLE_OUTPUT,
+                name = "Motor Task Home Timestamps and Self-Reported Scores",
+                cols = diary_cols,
+                metrics = metrics,
+                key_cols = ["measurement_id"],
+                upsert = state is not None,
+                batch_size = args.store_batch_size,
+                threads = args.store_threads)
+        if features is not None:
+            features_table = table_store.store_dataframe(
+                    syn,
+                    df = features,
+                    parent = TABLE_OUTPUT,
+                    name = "Home Sensor Window Features",
+                    cols = create_cols("features"),
+                    metrics = metrics,
+                    key_cols = ["measurement_id", "sensor", "sensor_location", "epoch"],
+                    upsert = state is not None,
+                    batch_size = args.store_batch_size,
+                    threads = args.store_threads)
+        if state is not None:
+            state.commit()
+    finally:
+        metrics.write(args.metrics_out)
 
 
 if __name__ == "__main__":
@@ -11,21 +11,28 @@ Motor Task Timestamps and Scores
             dyskinesia_left, dyskinesia_right, overall, validated, side
 '''
 
-import os
 import uuid
 import argparse
-import tempfile
-import multiprocessing
-import synapseclient as sc
-import synapseutils as su
 import pandas as pd
+import storage_backend
+import curation_pipeline
+import curation_state
+import table_store
+import sharding
+import stage_metrics
 
 TESTING = False
 SCORES = "syn18435302"
 MC10_MEASUREMENTS = "syn18822536" if TESTING else "syn18435632"
 SMARTWATCH_MEASUREMENTS = "syn18822537" if TESTING else "syn18435623"
-SMARTWATCH_SENSOR_NAME = "smartwatch"
-MC10_SENSOR_NAME = "mc10"
+SMARTWATCH_SENSOR_NAME = curation_pipeline.SMARTWATCH_SENSOR_NAME
+MC10_SENSOR_NAME = curation_pipeline.MC10_SENSOR_NAME
+SENSOR_STREAMS = [ # column, parent, filtering prefix, sensor
+        ("mc10_accelerometer", MC10_MEASUREMENTS, "Table9A", MC10_SENSOR_NAME),
+        ("mc10_gyroscope", MC10_MEASUREMENTS, "Table9B", MC10_SENSOR_NAME),
+        ("mc10_emg", MC10_MEASUREMENTS, "Table9C", MC10_SENSOR_NAME),
+        ("smartwatch_accelerometer", SMARTWATCH_MEASUREMENTS, "Table8",
+         SMARTWATCH_SENSOR_NAME)]
 FRAC_TO_STORE = 0.02 if TESTING else 1
 TABLE_OUTPUT =  "syn11611056" if TESTING else "syn18407520"
 TASK_CODE_MAP = { # synchronize with MJFF Levodopa release
@@ -60,176 +67,84 @@ SCORES_COL_MAP = {
         "Overall": "overall",
         "Validated": "validated",
         "Side": "smartwatch_side"}
+TASK_ID_NAMESPACE = uuid.uuid5(
+        uuid.NAMESPACE_URL, "https://www.synapse.org/#!Synapse:" + SCORES)
 
 
 def read_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--download-in-parallel", action="store_const",
-            const=True, default = False)
-    parser.add_argument("--upload-in-parallel", action="store_const",
-            const=True, default = False)
+    curation_pipeline.add_arguments(parser, FRAC_TO_STORE, tasks=True)
     args = parser.parse_args()
+    curation_pipeline.check_arguments(parser, args)
     return(args)
 
 
 def read_syn_table(syn, synapse_id, q = "select * from {}"):
-    q = syn.tableQuery(q.format(synapse_id))
-    df = q.asDataFrame()
+    df = syn.query_table(q.format(synapse_id))
     return df
 
 
-def parse_info_from_filename(fname, sensor):
-    if sensor == SMARTWATCH_SENSOR_NAME:
-        _, subject_id, year_month = os.path.splitext(fname)[0].split("_")
-        year, month = tuple(map(int, year_month.split("-")))
-    elif sensor == MC10_SENSOR_NAME:
-        subject_id = int(os.path.splitext(fname)[0].split("_")[1])
-        year, month = None, None
-    else:
-        raise TypeError("sensor must be one of {} or {}".format(
-            SMARTWATCH_SENSOR_NAME, MC10_SENSOR_NAME))
-    return subject_id, year, month
-
-
-def find_relevant_scores(fname, scores, sensor):
-    def is_match(t, year, month, f_subject_id, score_subject_id):
-        if int(f_subject_id) == int(score_subject_id):
-            if year is None or month is None:
-                return True
-            elif isinstance(year, int) and isinstance(month, int):
-                return year == t.year and month == t.month
-            else:
-                raise TypeError("Year and month must both be integers.")
-        else:
-            return False
-    subject_id, year, month = parse_info_from_filename(fname, sensor)
-    relevent_scores = scores.apply(
-            lambda s : is_match(s.start_utc, year, month, subject_id, s.subject_id),
-            axis = 1)
-    return scores[relevent_scores]
-
-
-def new_data_column(syn, scores, col, parent, filtering_prefix, sensor,
-                    download_in_parallel):
-    relevant_entities = download_relevant_children(
-            syn, parent, filtering_prefix, scores, sensor, download_in_parallel)
-    all_sliced_measurements = pd.DataFrame()
-    for syn_id in relevant_entities:
-        f, task_ids = (relevant_entities[syn_id]["synapse_file"],
-                       relevant_entities[syn_id]["task_ids"])
-        sliced_measurements = slice_sensor_measurement(f, scores, task_ids, sensor)
-        sliced_measurements = sliced_measurements.rename(
-                {"sensor_data": col}, axis = 1)
-        relevant_entities[syn_id]["data"] = sliced_measurements
-    if len(relevant_entities):
-        all_sliced_measurements = pd.concat(
-                [relevant_entities[syn_id]["data"] for syn_id in relevant_entities],
-                axis=0)
-    return(all_sliced_measurements)
-
-
-def download_relevant_children(syn, parent, filtering_prefix, scores, sensor,
-                               download_in_parallel=False):
+def index_scores(scores):
     """
+    Group scores by subject and by (subject, year, month) of `start_utc`
+    so that matching a file against them is a single dictionary lookup.
+
     Returns
     -------
-    dict with key synapse_id (str) and values synapse_file (File), task_ids (list)
+    dict with keys subject_id (int) or (subject_id, year, month) and
+    values the index labels of the matching scores
     """
-    _, _, entity_info = list(su.walk(syn, parent))[0]
-    entity_info = [(i, j) for i, j in entity_info if i.startswith(filtering_prefix)]
-    relevant_entities = {}
-    for fname, syn_id in entity_info:
-        relevant_scores = find_relevant_scores(fname, scores, sensor)
-        if len(relevant_scores):
-            relevant_entities[syn_id] = {"synapse_file": None,
-                                         "task_ids": relevant_scores.task_id}
-    ordered_synapse_ids = list(relevant_entities.keys())
-    if download_in_parallel:
-        mp = multiprocessing.dummy.Pool(4)
-        children = mp.map(syn.get, ordered_synapse_ids)
+    subject_ids = scores.subject_id.astype(int)
+    scores_index = dict(scores.groupby(subject_ids).groups)
+    scores_index.update(scores.groupby(
+        [subject_ids, scores.start_utc.dt.year, scores.start_utc.dt.month]).groups)
+    return scores_index
+
+
+def find_relevant_scores(fname, scores, sensor, scores_index=None):
+    if scores_index is None:
+        scores_index = index_scores(scores)
+    subject_id, year, month = curation_pipeline.parse_info_from_filename(
+            fname, sensor)
+    if year is None or month is None:
+        key = int(subject_id)
+    elif isinstance(year, int) and isinstance(month, int):
+        key = (int(subject_id), year, month)
     else:
-        children = list(map(syn.get, ordered_synapse_ids))
-    for syn_id, f in zip(ordered_synapse_ids, children):
-        relevant_entities[syn_id]["synapse_file"] = f
-    return relevant_entities
+        raise TypeError("Year and month must both be integers.")
+    if key not in scores_index:
+        return scores.iloc[:0]
+    return scores.loc[scores_index[key]]
 
 
-def slice_from_score(sensor_measurement, score, sensor):
+def sensor_curation(scores):
     """
     Returns
     -------
-    a pandas DataFrame with columns location and sensor_data
+    the curation_pipeline.SensorCuration of the task windows of `scores`
     """
-    result = pd.DataFrame(columns = ["sensor_location", "sensor_data"])
-    start, stop = score.loc["start_utc"], score.loc["stop_utc"]
-    relevant_range = sensor_measurement[start:stop]
-    if len(relevant_range) == 0:
-        pass
-    elif sensor == "mc10":
-        for location in relevant_range.Location.unique():
-            local_range = relevant_range.query("Location == @location")
-            local_range = local_range.drop(["SubjID", "Location"], axis = 1)
-            local_range = local_range.reset_index(drop=False)
-            time_zero = local_range.Timestamp.iloc[0]
-            local_range.Timestamp = local_range.Timestamp - time_zero
-            local_range.Timestamp = local_range.Timestamp.apply(
-                    lambda td : td.total_seconds())
-            location = "_".join(location.split())
-            result = result.append({"sensor_location": location,
-                                    "sensor_data": local_range},
-                                   ignore_index=True)
-    elif sensor == "smartwatch":
-        local_range = relevant_range.drop(["SubjID"], axis = 1)
-        local_range = local_range.reset_index(drop=False)
-        time_zero = local_range.Timestamp.iloc[0]
-        time_end = local_range.Timestamp.iloc[-1]
-        local_range.Timestamp = local_range.Timestamp - time_zero
-        local_range.Timestamp = local_range.Timestamp.apply(
-                lambda td : td.total_seconds())
-        result = result.append({"sensor_location": None,
-                                "sensor_data": local_range},
-                               ignore_index=True)
-    result.index = pd.Index([score.name] * len(result))
-    return result
-
-
-def slice_sensor_measurement(f, scores, relevant_task_ids, sensor):
-    sensor_measurement = pd.read_csv(f.path)
-    sensor_measurement.Timestamp = pd.to_datetime(sensor_measurement.Timestamp)
-    sensor_measurement.set_index("Timestamp", drop = True, inplace=True)
-    sensor_measurement.sort_index(inplace=True)
-    relevant_scores = scores.loc[relevant_task_ids,["start_utc","stop_utc"]]
-    measurements = relevant_scores.apply(
-            lambda score : slice_from_score(sensor_measurement, score, sensor),
-            axis = 1)
-    measurements = pd.concat(measurements.values, axis=0)
-    return(measurements)
-
-
-def replace_cols_with_filehandles(syn, df, cols, upload_in_parallel):
-    if upload_in_parallel:
-        mp = multiprocessing.dummy.Pool(4)
-        for col in cols:
-            df.loc[:,col] = list(mp.map(
-                    lambda df_ : replace_dataframe_with_filehandle(syn, df_),
-                    df[col]))
-    else:
-        for col in cols:
-            df.loc[:,col] = list(map(
-                    lambda df_ : replace_dataframe_with_filehandle(syn, df_),
-                    df[col]))
-
-
-def replace_dataframe_with_filehandle(syn, df):
-    if isinstance(df, pd.DataFrame):
-        f = tempfile.NamedTemporaryFile(suffix=".csv")
-        df.to_csv(f.name, index=False)
-        syn_f = syn.uploadSynapseManagedFileHandle(
-                f.name, mimetype="text/csv")
-        f.close()
-        return syn_f["id"]
-    else:
-        return ""
+    windows = pd.DataFrame({
+            "subject_id": scores.subject_id,
+            "start": scores.start_utc,
+            "stop": scores.stop_utc,
+            "task": scores.task_code}, index=scores.index)
+    scores_index = index_scores(scores)
+    def relevant_windows(fname, sensor):
+        return find_relevant_scores(fname, scores, sensor, scores_index).task_id
+    return curation_pipeline.SensorCuration(
+            windows, "task_id", SENSOR_STREAMS, relevant_windows)
+
+
+def task_id(subject_id, visit, task, start_utc, stop_utc, duplicate=0):
+    """
+    Returns
+    -------
+    a uuid (str) which is the same for the same task in every run
+    """
+    key = [subject_id, visit, task, start_utc.isoformat(), stop_utc.isoformat()]
+    if duplicate:
+        key.append(duplicate)
+    return str(uuid.uuid5(TASK_ID_NAMESPACE, "|".join(map(str, key))))
 
 
 def clean_scores(scores):
@@ -252,146 +167,165 @@ def clean_scores(scores):
     scores.stop_utc = pd.to_datetime(scores.stop_utc)
     invalid_scores = scores[(pd.isnull(scores.start_utc)) | (pd.isnull(scores.stop_utc))]
     scores = scores.drop(invalid_scores.index)
-    task_ids = [uuid.uuid4() for i in range(len(scores))]
+    task_cols = ["subject_id", "visit", "task", "start_utc", "stop_utc"]
+    # tell apart otherwise identical rows by their order
+    duplicate = scores.groupby(task_cols, dropna=False).cumcount()
+    task_ids = [task_id(*task) for task in zip(
+                    *[scores[c] for c in task_cols], duplicate)]
     scores["task_id"] = task_ids
     scores = scores.set_index("task_id", drop = False)
     return scores
 
 
-def move_index_to_column(df):
-    df.reset_index(drop=False, inplace=True)
-    df.rename({"index": "task_id"}, axis=1, inplace=True)
-
-
-def create_cols(table_type, syn=None):
+def create_cols(table_type, syn=None, packed=False):
     if table_type == MC10_SENSOR_NAME:
-        cols = [sc.Column(name="task_id", columnType="STRING"),
-                sc.Column(name="sensor_location", columnType="STRING"),
-                sc.Column(name="mc10_accelerometer", columnType="FILEHANDLEID"),
-                sc.Column(name="mc10_gyroscope", columnType="FILEHANDLEID"),
-                sc.Column(name="mc10_emg", columnType="FILEHANDLEID")]
+        cols = [{"name": "task_id", "columnType": "STRING"},
+                {"name": "sensor_location", "columnType": "STRING"},
+                {"name": "mc10_accelerometer", "columnType": "FILEHANDLEID"},
+                {"name": "mc10_gyroscope", "columnType": "FILEHANDLEID"},
+                {"name": "mc10_emg", "columnType": "FILEHANDLEID"}]
     elif table_type == SMARTWATCH_SENSOR_NAME:
-        cols = [sc.Column(name="task_id", columnType="STRING"),
-                sc.Column(name="smartwatch_accelerometer", columnType="FILEHANDLEID")]
+        cols = [{"name": "task_id", "columnType": "STRING"},
+                {"name": "smartwatch_accelerometer", "columnType": "FILEHANDLEID"}]
     elif table_type == "scores":
-        cols = list(syn.getTableColumns(SCORES))
+        cols = list(syn.get_table_columns(SCORES))
         for c in cols:
             c.pop('id')
             if c['name'] in SCORES_COL_MAP:
                 c['name'] = SCORES_COL_MAP[c['name']]
-        cols = [sc.Column(name="task_id",
-                          columnType="STRING")] + cols
+        cols = [{"name": "task_id", "columnType": "STRING"}] + cols
+    elif table_type == "features":
+        cols = [{"name": "task_id", "columnType": "STRING"},
+                {"name": "sensor", "columnType": "STRING"},
+                {"name": "sensor_location", "columnType": "STRING"},
+                {"name": "epoch", "columnType": "INTEGER"},
+                {"name": "epoch_start", "columnType": "DOUBLE"},
+                {"name": "activity_index", "columnType": "DOUBLE"},
+                {"name": "tremor_power", "columnType": "DOUBLE"},
+                {"name": "total_power", "columnType": "DOUBLE"},
+                {"name": "tremor_power_ratio", "columnType": "DOUBLE"},
+                {"name": "dominant_frequency", "columnType": "DOUBLE"}]
     else:
-        raise TypeError("table_type must be one of [{}, {}, {}]".format(
-            MC10_SENSOR_NAME, SMARTWATCH_SENSOR_NAME, "scores"))
+        raise TypeError("table_type must be one of [{}, {}, {}, {}]".format(
+            MC10_SENSOR_NAME, SMARTWATCH_SENSOR_NAME, "scores", "features"))
+    if packed: # sensor tables of --packed windows
+        cols.append({"name": "window_offset", "columnType": "INTEGER"})
     return cols
 
 
-def store_dataframe_to_synapse(syn, df, parent, name, cols):
-    schema = sc.Schema(name = name, columns = cols, parent = parent)
-    table = sc.Table(schema, df)
-    table = syn.store(table)
-    return table
-
-
 def main():
     args = read_args()
-    syn = sc.login()
-    scores = clean_scores(read_syn_table(syn, SCORES))
-
-    # curate dataframes containing respective data measurements
-    mc10_accelerometer = new_data_column(
-            syn,
-            scores = scores,
-            col = "mc10_accelerometer",
-            parent = MC10_MEASUREMENTS,
-            filtering_prefix = "Table9A",
-            sensor = "mc10",
-            download_in_parallel = args.download_in_parallel)
-    mc10_gyroscope = new_data_column(
-            syn,
-            scores = scores,
-            col = "mc10_gyroscope",
-            parent = MC10_MEASUREMENTS,
-            filtering_prefix = "Table9B",
-            sensor = "mc10",
-            download_in_parallel = args.download_in_parallel)
-    mc10_emg = new_data_column(
-            syn,
-            scores = scores,
-            col = "mc10_emg",
-            parent = MC10_MEASUREMENTS,
-            filtering_prefix = "Table9C",
-            sensor = "mc10",
-            download_in_parallel = args.download_in_parallel)
-    smartwatch_accelerometer = new_data_column(
-            syn,
-            scores = scores,
-            col = "smartwatch_accelerometer",
-            parent = SMARTWATCH_MEASUREMENTS,
-            filtering_prefix = "Table8",
-            sensor = "smartwatch",
-            download_in_parallel = args.download_in_parallel)
-    smartwatch_accelerometer = smartwatch_accelerometer.drop(
-            "sensor_location", axis=1)
-
-    # move task_id from index to column
-    for df in [mc10_accelerometer, mc10_gyroscope,
-               mc10_emg, smartwatch_accelerometer]:
-        move_index_to_column(df)
-
-    # combine mc10 measurements into a single file
-    merged_mc10 = pd.DataFrame()
-    if len(mc10_accelerometer) and len(mc10_gyroscope):
-        merged_mc10 = mc10_accelerometer.merge(mc10_gyroscope, how="outer")
-    if len(merged_mc10) and len(mc10_emg):
-        merged_mc10 = merged_mc10.merge(mc10_emg, how="outer")
-
-    # shuffle records so that file handle integer contains no useful information
-    shuffled_mc10 = merged_mc10.sample(frac=FRAC_TO_STORE)
-    shuffled_smartwatch = smartwatch_accelerometer.sample(frac=FRAC_TO_STORE)
-
-    # replace the dataframes with file handles
-    replace_cols_with_filehandles( # replaces in-place
-            syn,
-            df = shuffled_mc10,
-            cols = ["mc10_accelerometer", "mc10_gyroscope", "mc10_emg"],
-            upload_in_parallel = args.upload_in_parallel)
-    replace_cols_with_filehandles( # replaces in-place
-            syn,
-            df = shuffled_smartwatch,
-            cols = ["smartwatch_accelerometer"],
-            upload_in_parallel = args.upload_in_parallel)
-
-    # make the dataframes look pretty
-    shuffled_mc10.sort_values(["task_id", "sensor_location"], inplace=True)
-    shuffled_smartwatch.sort_values("task_id", inplace=True)
-
-    # backup in case we just created a bajillion file handles but
-    # are rejected during table store
-    shuffled_mc10.to_csv("mc10_backup.csv", index=False)
-    shuffled_smartwatch.to_csv("smartwatch_backup.csv", index=False)
-    scores.to_csv("scores_backup.csv", index=False)
-
-    # store to synapse
-    shuffled_mc10_table = store_dataframe_to_synapse(
-            syn,
-            df = shuffled_mc10,
-            parent = TABLE_OUTPUT,
-            name = "MC10 Sensor Measurements",
-            cols = create_cols(MC10_SENSOR_NAME))
-    shuffled_smartwatch_table = store_dataframe_to_synapse(
-            syn,
-            df = shuffled_smartwatch,
-            parent = TABLE_OUTPUT,
-            name = "Smartwatch Sensor Measurements",
-            cols = create_cols(SMARTWATCH_SENSOR_NAME))
-    scores_table = store_dataframe_to_synapse(
-            syn,
-            df = scores,
-            parent = TABLE_OUTPUT,
-            name = "Motor Task Timestamps and Scores",
-            cols = create_cols("scores", syn=syn))
+    metrics = stage_metrics.StageMetrics(
+            profile = args.profile,
+            trace_memory = args.trace_memory,
+            progress = args.progress)
+    try:
+        syn = storage_backend.login(args.local_backend)
+        cache = curation_pipeline.sensor_cache(args)
+        state = None
+        if args.incremental is not None:
+            state = curation_state.CurationState(args.incremental)
+        if args.merge:
+            with metrics.stage("read_shards") as counts:
+                names = ["mc10", "smartwatch", "scores"]
+                if args.features:
+                    names.append("features")
+                tables = sharding.read_shards(args.shard_dir, names)
+                shuffled_mc10, shuffled_smartwatch, scores = tables[:3]
+                features = tables[3] if args.features else None
+                counts["rows"] = len(scores)
+        else:
+            with metrics.stage("read_scores") as counts:
+                scores = clean_scores(read_syn_table(syn, SCORES))
+                if args.shard is not None:
+                    scores = scores[sharding.in_shard(scores.subject_id, args.shard)]
+                counts["rows"] = len(scores)
+
+            # curate dataframes containing respective file handles
+            tables = curation_pipeline.run_curation(
+                    syn, sensor_curation(scores), args, cache, metrics, state)
+            if tables is None: # only indexed or planned
+                return
+            shuffled_mc10, shuffled_smartwatch, features = tables
+            if args.shard is not None:
+                tables = {"mc10": shuffled_mc10,
+                          "smartwatch": shuffled_smartwatch,
+                          "scores": scores}
+                if features is not None:
+                    tables["features"] = features
+                sharding.write_shard(args.shard_dir, args.shard, tables)
+                return
+
+        # make the dataframes look pretty
+        shuffled_mc10.sort_values(["task_id", "sensor_location"], inplace=True)
+        shuffled_smartwatch.sort_values("task_id", inplace=True)
+        if features is not None:
+            features.sort_values(
+                    ["task_id", "sensor", "sensor_location", "epoch"],
+                    inplace=True)
+
+        # backup in case we just created a bajillion file handles but
+        # are rejected during table store
+        shuffled_mc10.to_csv("mc10_backup.csv", index=False)
+        shuffled_smartwatch.to_csv("smartwatch_backup.csv", index=False)
+        scores.to_csv("scores_backup.csv", index=False)
+        if features is not None:
+            features.to_csv("features_backup.csv", index=False)
+
+        # store to synapse
+        shuffled_mc10_table = table_store.store_dataframe(
+                syn,
+                df = shuffled_mc10,
+                parent = TABLE_OUTPUT,
+                name = "MC10 Sensor Measurements",
+                cols = create_cols(
+                        MC10_SENSOR_NAME,
+                        packed = "window_offset" in shuffled_mc10.columns),
+                metrics = metrics,
+                key_cols = ["task_id", "sensor_location"],
+                upsert = state is not None,
+                batch_size = args.store_batch_size,
+                threads = args.store_threads)
+        shuffled_smartwatch_table = table_store.store_dataframe(
+                syn,
+                df = shuffled_smartwatch,
+                parent = TABLE_OUTPUT,
+                name = "Smartwatch Sensor Measurements",
+                cols = create_cols(
+                        SMARTWATCH_SENSOR_NAME,
+                        packed = "window_offset" in shuffled_smartwatch.columns),
+                metrics = metrics,
+                key_cols = ["task_id"],
+                upsert = state is not None,
+                batch_size = args.store_batch_size,
+                threads = args.store_threads)
+        scores_table = table_store.store_dataframe(
+                syn,
+                df = scores,
+                parent = TABLE_OUTPUT,
+                name = "Motor Task Timestamps and Scores",
+                cols = create_cols("scores", syn=syn),
+                metrics = metrics,
+                key_cols = ["task_id"],
+                upsert = state is not None,
+                batch_size = args.store_batch_size,
+                threads = args.store_threads)
+        if features is not None:
+            features_table = table_store.store_dataframe(
+                    syn,
+                    df = features,
+                    parent = TABLE_OUTPUT,
+                    name = "Sensor Window Features",
+                    cols = create_cols("features"),
+                    metrics = metrics,
+                    key_cols = ["task_id", "sensor", "sensor_location", "epoch"],
+                    upsert = state is not None,
+                    batch_size = args.store_batch_size,
+                    threads = args.store_threads)
+        if state is not None:
+            state.commit()
+    finally:
+        metrics.write(args.metrics_out)
 
 
 if __name__ == "__main__":
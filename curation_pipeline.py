@@ -0,0 +1,885 @@
+'''
+A small thread based pipeline for overlapping network and CPU bound work.
+
+Each `Stage` runs a function on a pool of threads and passes whatever it
+yields on to the next stage through a bounded queue, so a stage starts as
+soon as its first input is ready and a slow stage applies backpressure to
+the stages before it instead of letting their output pile up in memory.
+
+The rest of the module drives the curation of sensor windows shared by the
+curation scripts: matching source files to windows, selecting, downloading,
+slicing and uploading them. A script describes its windows, their id column
+and the streams of source files to slice them from as a `SensorCuration`
+and keeps only the code of its own tables.
+'''
+
+import os
+import queue
+import random
+import shutil
+import importlib.util
+import tempfile
+import threading
+import collections
+import multiprocessing
+import multiprocessing.dummy
+import pandas as pd
+import sensor_io
+import upload_manifest
+import download_manager
+import file_ranges
+import window_query
+import sharding
+import run_plan
+import window_serialization
+import window_features
+import window_store
+import sensor_windows
+import stage_metrics
+
+MC10_SENSOR_NAME = "mc10"
+SMARTWATCH_SENSOR_NAME = "smartwatch"
+_STOP = object()
+
+
+class Stage(object):
+    """
+    Parameters
+    ----------
+    name : used in error messages
+    func : called on each input, returning an iterable of outputs
+    threads : number of threads running `func`
+    maxsize : number of inputs allowed to wait for this stage
+    """
+
+    def __init__(self, name, func, threads=1, maxsize=0):
+        self.name = name
+        self.func = func
+        self.threads = max(1, threads)
+        self.maxsize = maxsize
+
+
+class PipelineError(Exception):
+    pass
+
+
+def run_pipeline(items, stages, on_abort=None):
+    """
+    Push `items` through `stages`. Should a stage fail, `on_abort` is
+    called, if given, to stop an `items` iterator which would otherwise
+    keep waiting for work that will no longer be consumed.
+
+    Returns
+    -------
+    list of everything yielded by the last stage, in completion order
+    """
+    queues = [queue.Queue(maxsize=s.maxsize) for s in stages]
+    results = []
+    failures = []
+    abort = threading.Event()
+    lock = threading.Lock()
+    running = [s.threads for s in stages]
+
+    def put(q, item):
+        while not abort.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def fail(name, e):
+        failures.append((name, e))
+        abort.set()
+        if on_abort is not None:
+            on_abort()
+
+    def emit(i, item):
+        if i + 1 < len(stages):
+            put(queues[i+1], item)
+        else:
+            with lock:
+                results.append(item)
+
+    def feed():
+        try:
+            for item in items:
+                if abort.is_set():
+                    break
+                put(queues[0], item)
+        except Exception as e:
+            fail("input", e)
+        for _ in range(stages[0].threads):
+            put(queues[0], _STOP)
+
+    def work(i):
+        stage = stages[i]
+        while not abort.is_set():
+            try:
+                item = queues[i].get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _STOP:
+                break
+            try:
+                for output in stage.func(item):
+                    emit(i, output)
+            except Exception as e:
+                fail(stage.name, e)
+        with lock:
+            running[i] -= 1
+            last = running[i] == 0
+        if last and i + 1 < len(stages):
+            for _ in range(stages[i+1].threads):
+                put(queues[i+1], _STOP)
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for i, stage in enumerate(stages):
+        threads += [threading.Thread(target=work, args=(i,), daemon=True)
+                    for _ in range(stage.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if failures:
+        name, e = failures[0]
+        raise PipelineError("Stage {} failed: {!r}".format(name, e)) from e
+    return results
+
+
+def add_arguments(parser, frac_to_store, tasks=False):
+    """
+    Add the arguments shared by the curation scripts to `parser`, an
+    argparse.ArgumentParser. --tasks is added if `tasks`, for windows of a
+    task. --sample-frac defaults to `frac_to_store`.
+    """
+    parser.add_argument("--download-in-parallel", action="store_const",
+            const=True, default = False,
+            help="Download several files at a time, tuning the number of "
+                 "concurrent downloads to the throughput.")
+    parser.add_argument("--download-threads", type=int, default=None,
+            help="Download this many files at a time.")
+    parser.add_argument("--download-budget-gb", type=float, default=None,
+            help="Keep at most this many GB of downloaded files which are "
+                 "not yet sliced on disk.")
+    parser.add_argument("--download-dir", default=None,
+            help="Download files to this directory rather than a "
+                 "temporary one. Files are deleted once sliced.")
+    parser.add_argument("--upload-in-parallel", action="store_const",
+            const=True, default = False)
+    parser.add_argument("--chunksize", type=int, default=None,
+            help="Stream sensor files in chunks of this many rows, keeping "
+                 "only the rows inside a window.")
+    parser.add_argument("--float32", action="store_const",
+            const=True, default = False,
+            help="Read sensor channels as float32 rather than float64, "
+                 "halving their memory, where that precision suffices.")
+    parser.add_argument("--cache-dir", default=None,
+            help="Keep parsed sensor files in this directory across runs.")
+    parser.add_argument("--cache-size-gb", type=float, default=None,
+            help="Evict least recently used cache entries beyond this size.")
+    parser.add_argument("--workers", type=int, default=1,
+            help="Parse and slice sensor files in this many processes.")
+    parser.add_argument("--max-pending-windows", type=int, default=256,
+            help="Number of sliced windows allowed to wait for upload. "
+                 "With --packed, twice --workers pieces of work wait "
+                 "instead.")
+    parser.add_argument("--compression", default=None,
+            choices=["gzip", "zstd"],
+            help="Compress window files before uploading.")
+    parser.add_argument("--packed", action="store_const",
+            const=True, default = False,
+            help="Upload the windows of each subject (or smartwatch file) "
+                 "packed into one .npz container per modality, referred to "
+                 "by file handle and window_offset, rather than one csv per "
+                 "window. Containers are deflated if --compression is given.")
+    parser.add_argument("--features", action="store_const",
+            const=True, default = False,
+            help="Compute the activity index and tremor band features of "
+                 "the accelerometer windows as they are sliced and store "
+                 "them to a features table.")
+    parser.add_argument("--float-format", default=None,
+            help="Format of floats in window files, e.g. %%.6f")
+    parser.add_argument("--local-backend", default=None,
+            help="Read inputs from and write outputs to this directory "
+                 "(see storage_backend.LocalBackend) instead of Synapse.")
+    parser.add_argument("--subjects", type=window_query.parse_ids,
+            default=None,
+            help="Only curate the windows of these comma separated subject "
+                 "ids.")
+    if tasks:
+        parser.add_argument("--tasks", type=lambda s: s.split(","),
+                default=None,
+                help="Only curate the windows of these comma separated task "
+                     "codes, e.g. drnkg,ftnl.")
+    parser.add_argument("--start-date", type=window_query.parse_date,
+            default=None,
+            help="Only curate the windows starting on or after this date.")
+    parser.add_argument("--end-date", type=window_query.parse_date,
+            default=None,
+            help="Only curate the windows starting before this date.")
+    parser.add_argument("--sample-frac", type=float, default=frac_to_store,
+            help="Only curate this fraction of the windows, sampled by "
+                 "window id so that the same windows are sampled in every "
+                 "run. Defaults to FRAC_TO_STORE.")
+    parser.add_argument("--file-ranges", default=None, metavar="RANGES_FILE",
+            help="Record the first and last timestamp of each source file "
+                 "in this JSON file, and skip the files whose recorded "
+                 "range overlaps none of their windows.")
+    parser.add_argument("--index-windows", default=None, metavar="INDEX_FILE",
+            help="Rather than curating, parse every source file into "
+                 "--cache-dir and record where each window lies in it in "
+                 "this SQLite file, to read windows on demand with "
+                 "window_store.WindowStore.")
+    parser.add_argument("--plan", action="store_const",
+            const=True, default = False,
+            help="Rather than curating, print the files, windows and file "
+                 "handles a run with these arguments would curate and "
+                 "estimate its upload bytes, peak memory and temporary "
+                 "disk, without downloading any sensor data.")
+    parser.add_argument("--manifest", default=None,
+            help="Record uploaded file handles in this SQLite file and skip "
+                 "windows it already records when the run is restarted.")
+    parser.add_argument("--incremental", default=None, metavar="STATE_FILE",
+            help="Only slice and upload the windows which are new or whose "
+                 "source files changed since the runs recorded in this "
+                 "state file, and add them to the existing output tables.")
+    parser.add_argument("--shard", type=sharding.parse_shard, default=None,
+            metavar="i/N",
+            help="Only curate the subjects in shard i of N (0 <= i < N) and "
+                 "write their tables to --shard-dir rather than storing "
+                 "them. Give each shard its own --manifest and --metrics-out.")
+    parser.add_argument("--merge", action="store_const",
+            const=True, default = False,
+            help="Combine the tables of all shards in --shard-dir and "
+                 "store them.")
+    parser.add_argument("--shard-dir", default="shards",
+            help="Directory of the tables of each shard.")
+    parser.add_argument("--store-batch-size", type=int, default=None,
+            help="Append output table rows in chunks of this many rows, "
+                 "retrying failed chunks, rather than in a single request.")
+    parser.add_argument("--store-threads", type=int, default=4,
+            help="Number of chunks of --store-batch-size stored at a time.")
+    parser.add_argument("--metrics-out", default=None,
+            help="Write the time, CPU, bytes, row and window counts and "
+                 "peak memory of each stage to this JSON file.")
+    parser.add_argument("--progress", action="store_const",
+            const=True, default = False,
+            help="Print a progress line as stages complete.")
+    parser.add_argument("--profile", default=None, metavar="STAGE",
+            help="Run this stage (e.g. slice) under cProfile, writing its "
+                 "stats to STAGE.prof.")
+    parser.add_argument("--trace-memory", default=None, metavar="STAGE",
+            help="Record the peak memory allocated by this stage with "
+                 "tracemalloc.")
+
+
+def check_arguments(parser, args):
+    """
+    Exit through `parser` if `args` combine arguments which cannot be.
+    """
+    if args.index_windows is not None and args.cache_dir is None:
+        parser.error("--index-windows requires --cache-dir")
+    if args.plan and (args.merge or args.index_windows is not None):
+        parser.error("--plan cannot be combined with --merge or --index-windows")
+    if args.shard is not None and args.merge:
+        parser.error("--shard and --merge are separate runs")
+    if args.incremental is not None and (args.shard is not None or args.merge):
+        parser.error("--incremental cannot be combined with --shard or --merge")
+    if args.compression == "zstd" and not args.packed and \
+            importlib.util.find_spec("zstandard") is None:
+        parser.error("--compression zstd requires the zstandard package")
+
+
+def sensor_cache(args):
+    """
+    Returns
+    -------
+    the sensor_io.SensorCache of --cache-dir, or None
+    """
+    if args.cache_dir is None:
+        return None
+    max_bytes = (None if args.cache_size_gb is None
+                 else int(args.cache_size_gb * 2**30))
+    return sensor_io.SensorCache(args.cache_dir, max_bytes)
+
+
+class SensorCuration(object):
+    """
+    The windows a curation script curates and where their sensor data is.
+
+    Parameters
+    ----------
+    windows : pandas DataFrame indexed by window id (task_id or
+        measurement_id) with columns subject_id, start and stop and, should
+        windows be of a task, task
+    id_col : name of the window id column of the output tables
+    streams : list of tuples (column, parent, filtering prefix, sensor),
+        the source files of each sensor column
+    relevant_windows : function (fname, sensor) returning the ids of the
+        windows a source file named `fname` may hold
+    """
+
+    def __init__(self, windows, id_col, streams, relevant_windows):
+        self.windows = windows
+        self.id_col = id_col
+        self.streams = streams
+        self.relevant_windows = relevant_windows
+
+    def columns(self, sensor):
+        return [col for col, _, _, s in self.streams if s == sensor]
+
+
+def parse_info_from_filename(fname, sensor):
+    if sensor == SMARTWATCH_SENSOR_NAME:
+        _, subject_id, year_month = os.path.splitext(fname)[0].split("_")
+        year, month = tuple(map(int, year_month.split("-")))
+    elif sensor == MC10_SENSOR_NAME:
+        subject_id = int(os.path.splitext(fname)[0].split("_")[1])
+        year, month = None, None
+    else:
+        raise TypeError("sensor must be one of {} or {}".format(
+            SMARTWATCH_SENSOR_NAME, MC10_SENSOR_NAME))
+    return subject_id, year, month
+
+
+def plan_sensor_work(syn, curation):
+    """
+    List each parent folder of `curation.streams` once and match its files
+    against its windows. The MC10 files of a subject (one per modality) are
+    grouped into a single piece of work, so that their windows can be
+    joined directly rather than merged table-wide afterwards.
+
+    Returns
+    -------
+    list of tuples (sensor, files, window_ids) where files is a dict with
+    key column name and value file id
+    """
+    listings = {}
+    work = collections.OrderedDict()
+    for col, parent, filtering_prefix, sensor in curation.streams:
+        if parent not in listings:
+            listings[parent] = syn.list_children(parent)
+        for fname, syn_id in listings[parent]:
+            if not fname.startswith(filtering_prefix):
+                continue
+            if sensor == MC10_SENSOR_NAME:
+                subject_id, _, _ = parse_info_from_filename(fname, sensor)
+                key = (sensor, int(subject_id))
+            else:
+                key = (sensor, syn_id)
+            if key not in work:
+                work[key] = (sensor, {},
+                             curation.relevant_windows(fname, sensor))
+            if col in work[key][1]:
+                raise ValueError("Found more than one {} file for {}".format(
+                    filtering_prefix, key))
+            work[key][1][col] = syn_id
+    return [w for w in work.values() if len(w[2])]
+
+
+def slice_to_file(f, windows, sensor, chunksize, cache, path):
+    """
+    Process pool worker. Slices every window of `windows` out of `f` and
+    packs them to `path`, which is cheaper to return than DataFrames.
+
+    Returns
+    -------
+    tuple (path, the sensor_io.TimestampRange of `f`)
+    """
+    file_range = sensor_io.TimestampRange()
+    measurements = slice_sensor_measurement(
+            f, windows, windows.index, sensor, chunksize, cache,
+            file_range=file_range)
+    sensor_windows.pack_windows(measurements, windows.index, path)
+    return path, file_range
+
+
+def slice_sensor_measurement(f, windows, window_ids, sensor,
+                             chunksize=None, cache=None, metrics=None,
+                             file_range=None):
+    """
+    Returns
+    -------
+    the sensor_windows.slice_windows of the `window_ids` of `windows` (see
+    `SensorCuration`) in Synapse File `f`. The timestamps of `f` are added
+    to `file_range`, a sensor_io.TimestampRange, if given.
+    """
+    if metrics is None:
+        metrics = stage_metrics.StageMetrics()
+    relevant_windows = windows.loc[window_ids, ["start", "stop"]]
+    if chunksize is not None and (cache is None or f not in cache):
+        # parsing and slicing are interleaved, both count as slicing
+        with metrics.stage("slice") as counts:
+            measurements = sensor_windows.stream_windows(
+                    f.path,
+                    window_ids = relevant_windows.index,
+                    starts = relevant_windows.start,
+                    stops = relevant_windows.stop,
+                    sensor = sensor,
+                    chunksize = chunksize,
+                    dtype = sensor_io.sensor_dtypes(
+                        f.path, getattr(f, "float_dtype", None)),
+                    file_range = file_range)
+            results = {}
+            for i, window in measurements:
+                # a later result for a window replaces the earlier one
+                results[i] = window
+            measurements = [results.pop(i) for i in sorted(results)]
+            if len(measurements):
+                measurements = pd.concat(measurements, axis=0)
+            else:
+                measurements = pd.DataFrame(
+                        columns = ["sensor_location", "sensor_data"])
+            counts["windows"] = len(measurements)
+        return measurements
+    with metrics.stage("parse") as counts:
+        sensor_measurement = sensor_io.read_sensor_measurement(f, cache)
+        counts["rows"] = len(sensor_measurement)
+        if file_range is not None:
+            file_range.update(sensor_measurement.index)
+    with metrics.stage("slice") as counts:
+        measurements = sensor_windows.slice_windows(
+                sensor_measurement,
+                window_ids = relevant_windows.index,
+                starts = relevant_windows.start,
+                stops = relevant_windows.stop,
+                sensor = sensor)
+        counts["windows"] = len(measurements)
+    return measurements
+
+
+def replace_dataframe_with_filehandle(syn, df, uploader=None):
+    if uploader is None:
+        uploader = window_serialization.FileHandleUploader(syn)
+    return uploader.upload(df)
+
+
+def join_modalities(sliced):
+    """
+    Join the windows sliced from the file of each column on
+    (window id, sensor_location).
+
+    Returns
+    -------
+    OrderedDict with key (window id, sensor_location) and value a dict with
+    key column name and value the window's DataFrame
+    """
+    windows = collections.OrderedDict()
+    for col in sliced:
+        for window_id, location, data in zip(
+                sliced[col].index, sliced[col].sensor_location,
+                sliced[col].sensor_data):
+            windows.setdefault((window_id, location), {})[col] = data
+    return windows
+
+
+def extract_features(sensor, keys, windows, id_col):
+    """
+    Returns
+    -------
+    pandas DataFrame of the window_features.window_features of the
+    accelerometer windows of `keys` (tuples (window id, sensor_location))
+    in `windows`, as returned by `join_modalities`, with window ids in
+    column `id_col`
+    """
+    col = "{}_accelerometer".format(sensor)
+    keys = [key for key in keys
+            if isinstance(windows[key].get(col), pd.DataFrame)]
+    features = window_features.window_features(
+            [windows[key][col] for key in keys])
+    ids = pd.DataFrame(keys, columns=[id_col, "sensor_location"]).iloc[
+            features.pop("window").values.astype(int)]
+    ids.insert(1, "sensor", sensor)
+    return pd.concat([ids.reset_index(drop=True),
+                      features.reset_index(drop=True)], axis=1)
+
+
+def empty_features(id_col):
+    return pd.DataFrame(columns=[id_col, "sensor", "sensor_location"] +
+                                window_features.FEATURE_COLUMNS)
+
+
+def index_windows(syn, curation, store, metrics=None):
+    """
+    Record the windows of every stream of `curation` in `store`, a
+    window_store.WindowStore, without slicing or uploading them.
+
+    Returns
+    -------
+    the number of windows indexed
+    """
+    if metrics is None:
+        metrics = stage_metrics.StageMetrics()
+    indexed = 0
+    for sensor, files, window_ids in plan_sensor_work(syn, curation):
+        with metrics.stage("index", windows=len(window_ids)):
+            relevant_windows = curation.windows.loc[window_ids]
+            for col in files:
+                indexed += store.add_windows(
+                        syn.get(files[col]), files[col], col,
+                        window_ids = relevant_windows.index,
+                        starts = relevant_windows.start,
+                        stops = relevant_windows.stop,
+                        sensor = sensor)
+    return indexed
+
+
+def file_versions(syn, work, in_parallel=False):
+    """
+    Returns
+    -------
+    dict with key file id and value the current version of each file of
+    `work`
+    """
+    syn_ids = sorted({syn_id for _, files, _ in work for syn_id in files.values()})
+    if in_parallel:
+        with multiprocessing.dummy.Pool(4) as mp:
+            versions = mp.map(syn.file_version, syn_ids)
+    else:
+        versions = list(map(syn.file_version, syn_ids))
+    return dict(zip(syn_ids, versions))
+
+
+def window_bounds(windows):
+    """
+    Returns
+    -------
+    dict with key window id and value (start, stop) in integer nanoseconds,
+    which unlike window ids identify a window across runs
+    """
+    starts = sensor_windows.to_datetime64(windows.start).view("int64")
+    stops = sensor_windows.to_datetime64(windows.stop).view("int64")
+    return dict(zip(windows.index, zip(starts.tolist(), stops.tolist())))
+
+
+def resume_from_manifest(manifest, work, bounds, versions):
+    """
+    Split `work` into the windows still to be curated and the uploaded
+    windows a previous run recorded in `manifest` for the same files at the
+    same `versions`. Windows the previous run was not asked for, e.g. as it
+    sampled fewer windows, are still to be curated.
+
+    Returns
+    -------
+    tuple (remaining work, list of uploaded windows)
+    """
+    remaining, resumed = [], []
+    for sensor, files, window_ids in work:
+        item = manifest.completed_item(manifest_item_key(files, versions))
+        if item is None:
+            remaining.append((sensor, files, window_ids))
+            continue
+        requested, windows = item
+        requested = set(map(tuple, requested))
+        done = window_ids.map(lambda window_id: bounds[window_id] in requested)
+        done = done.to_numpy(dtype=bool)
+        if not done.all():
+            remaining.append((sensor, files, window_ids[~done]))
+        by_bounds = {}
+        for window_id in window_ids[done]:
+            by_bounds.setdefault(bounds[window_id], []).append(window_id)
+        for start, stop, location, file_handles in windows:
+            for window_id in by_bounds.get((start, stop), []):
+                resumed.append((sensor, window_id, location, file_handles))
+    return remaining, resumed
+
+
+def manifest_item_key(files, versions):
+    return ",".join(sorted("{}@{}".format(syn_id, versions[syn_id])
+                           for syn_id in files.values()))
+
+
+def manifest_window_key(syn_id, version, bounds, location):
+    return "|".join(map(str, (syn_id, version) + bounds + (location,)))
+
+
+def select_sensor_work(syn, curation, args, metrics, state=None):
+    """
+    Plan the work of a run and narrow it down to the windows selected by
+    `args` (see window_query.WindowQuery), not yet curated according to
+    `state` and, given --file-ranges, overlapping their files.
+
+    Returns
+    -------
+    tuple (work, bounds, versions, ranges) of the work, as returned by
+    `plan_sensor_work`, the `window_bounds` of `curation`, the version of
+    each file (None unless checked) and the file_ranges.FileRangeIndex (or
+    None)
+    """
+    with metrics.stage("list") as counts:
+        work = plan_sensor_work(syn, curation)
+        counts["windows"] = sum(len(ids) for _, _, ids in work)
+    bounds = window_bounds(curation.windows)
+    query = window_query.WindowQuery(
+            subjects = args.subjects,
+            tasks = getattr(args, "tasks", None),
+            start = args.start_date,
+            end = args.end_date,
+            frac = args.sample_frac)
+    with metrics.stage("select") as counts:
+        selected = query.select(
+                curation.windows, bounds,
+                task_col = "task" if "task" in curation.windows else None)
+        work = query.filter_work(work, selected)
+        counts["windows"] = sum(len(ids) for _, _, ids in work)
+    versions = None
+    if (state is not None or args.file_ranges is not None or
+            args.manifest is not None):
+        with metrics.stage("check_versions") as counts:
+            versions = file_versions(syn, work, args.download_in_parallel)
+            if state is not None:
+                work = state.filter_work(work, versions)
+            counts["windows"] = sum(len(ids) for _, _, ids in work)
+    ranges = None
+    if args.file_ranges is not None:
+        ranges = file_ranges.FileRangeIndex(args.file_ranges)
+        with metrics.stage("prune") as counts:
+            work = ranges.prune(work, versions, bounds)
+            counts["windows"] = sum(len(ids) for _, _, ids in work)
+    return work, bounds, versions, ranges
+
+
+def plan_run(syn, curation, args, metrics=None, state=None):
+    """
+    Estimate what curating the windows of `curation` with `args` would need
+    (see run_plan.estimate) from file metadata alone.
+
+    Returns
+    -------
+    dict of the estimates
+    """
+    if metrics is None:
+        metrics = stage_metrics.StageMetrics()
+    work, bounds, versions, ranges = select_sensor_work(
+            syn, curation, args, metrics, state)
+    with metrics.stage("plan") as counts:
+        sizes = run_plan.file_sizes(syn, work, args.download_in_parallel)
+        counts["windows"] = sum(len(ids) for _, _, ids in work)
+    download_threads = args.download_threads
+    if download_threads is None and not args.download_in_parallel:
+        download_threads = 1
+    return run_plan.estimate(
+            work, bounds, sizes, ranges, versions,
+            packed = args.packed,
+            slice_threads = max(1, args.workers),
+            download_threads = download_threads,
+            max_bytes = (None if args.download_budget_gb is None
+                         else int(args.download_budget_gb * 2**30)),
+            max_pending_windows = args.max_pending_windows)
+
+
+def curate_sensor_measurements(syn, curation, args, cache=None, metrics=None,
+                               state=None, features=None):
+    """
+    Download, slice and upload the windows of every stream of `curation` as
+    a pipeline, so that downloads, slicing and uploads of all streams
+    overlap. Only the files of the windows selected by the --subjects,
+    --tasks, --start-date, --end-date and --sample-frac arguments (see
+    window_query.WindowQuery) are downloaded.
+
+    Returns
+    -------
+    tuple of pandas DataFrames (mc10, smartwatch) of file handle ids. If a
+    curation_state.CurationState `state` is given, only of the windows which
+    are new or whose source files changed since the runs it records.
+    If `features` is a list, the `extract_features` of the windows sliced
+    in this run are appended to it.
+    """
+    if metrics is None:
+        metrics = stage_metrics.StageMetrics()
+    work, bounds, versions, ranges = select_sensor_work(
+            syn, curation, args, metrics, state)
+    resumed = []
+    manifest = None
+    if args.manifest is not None:
+        manifest = upload_manifest.UploadManifest(args.manifest)
+        work, resumed = resume_from_manifest(
+                manifest, work, bounds, versions)
+    # interleave streams and hide the order of windows from file handle ids
+    random.shuffle(work)
+    pool = multiprocessing.Pool(args.workers) if args.workers > 1 else None
+    staging = tempfile.mkdtemp()
+    uploader = window_serialization.FileHandleUploader(
+            syn, compression=args.compression, float_format=args.float_format)
+    download_threads = args.download_threads
+    if download_threads is None and not args.download_in_parallel:
+        download_threads = 1
+    downloader = download_manager.DownloadManager(
+            syn,
+            threads = download_threads,
+            max_bytes = (None if args.download_budget_gb is None
+                         else int(args.download_budget_gb * 2**30)),
+            directory = args.download_dir,
+            metrics = metrics)
+
+    def slice_files(item):
+        sensor, files, window_ids, downloaded = item
+        if args.float32:
+            downloaded = {col: sensor_io.SourceFile(
+                              downloaded[col], float_dtype="float32")
+                          for col in downloaded}
+        # ranges are gathered while slicing, unless already recorded
+        timestamp_ranges = {col: sensor_io.TimestampRange()
+                            for col in downloaded
+                            if ranges is not None and ranges.get(
+                                files[col], versions[files[col]]) is None}
+        try:
+            if pool is None:
+                sliced = {col: slice_sensor_measurement(
+                              downloaded[col], curation.windows, window_ids,
+                              sensor, args.chunksize, cache, metrics,
+                              timestamp_ranges.get(col))
+                          for col in downloaded}
+            else:
+                # CPU time of the slicing itself is spent in the pool
+                with metrics.stage("slice") as counts:
+                    jobs = {col: pool.apply_async(slice_to_file, (
+                                sensor_io.SourceFile(downloaded[col]),
+                                curation.windows.loc[window_ids, ["start","stop"]],
+                                sensor, args.chunksize, cache,
+                                os.path.join(staging, files[col] + ".npz")))
+                            for col in downloaded}
+                    sliced = {}
+                    for col in jobs:
+                        path, file_range = jobs[col].get()
+                        if col in timestamp_ranges:
+                            timestamp_ranges[col] = file_range
+                        sliced[col] = sensor_windows.unpack_windows(path, window_ids)
+                        os.remove(path)
+                    counts["windows"] = sum(len(sliced[col]) for col in sliced)
+        finally:
+            # also on failure, or downloads waiting for budget never start
+            downloader.release(files)
+        for col, file_range in timestamp_ranges.items():
+            ranges.record(files[col], versions[files[col]],
+                          file_range.first, file_range.last, file_range.rows)
+        with metrics.stage("merge") as counts:
+            windows = join_modalities(sliced)
+            keys = list(windows)
+            random.shuffle(keys)
+            counts["windows"] = len(keys)
+        if features is not None:
+            with metrics.stage("features", windows=len(keys)):
+                features.append(extract_features(
+                        sensor, keys, windows, curation.id_col))
+        if manifest is not None:
+            manifest.begin_item(
+                    manifest_item_key(files, versions),
+                    [list(bounds[window_id]) for window_id in window_ids],
+                    len(keys))
+        if args.packed:
+            if len(keys):
+                yield sensor, files, keys, windows
+            return
+        for window_id, location in keys:
+            yield (sensor, files, window_id, location,
+                   windows[(window_id, location)])
+
+    def upload(item):
+        sensor, files, window_id, location, data = item
+        with metrics.stage("upload", windows=1):
+            file_handles = {}
+            for col in data:
+                file_handle = None
+                if manifest is not None:
+                    key = manifest_window_key(
+                            files[col], versions[files[col]],
+                            bounds[window_id], location)
+                    file_handle = manifest.get(key)
+                if file_handle is None:
+                    file_handle = replace_dataframe_with_filehandle(
+                            syn, data[col], uploader)
+                    if manifest is not None:
+                        manifest.record(key, file_handle)
+                file_handles[col] = file_handle
+            if manifest is not None:
+                manifest.finish_window(manifest_item_key(files, versions),
+                        list(bounds[window_id]) + [location, file_handles])
+        yield sensor, window_id, location, file_handles
+
+    def upload_packed(item):
+        sensor, files, keys, windows = item
+        with metrics.stage("upload", windows=len(keys)):
+            file_handles = {col: uploader.upload_packed(
+                                [windows[key].get(col) for key in keys], keys)
+                            for col in files}
+        for offset, (window_id, location) in enumerate(keys):
+            window_file_handles = dict(file_handles, window_offset=offset)
+            if manifest is not None:
+                manifest.finish_window(manifest_item_key(files, versions),
+                        list(bounds[window_id]) + [location, window_file_handles])
+            yield sensor, window_id, location, window_file_handles
+
+    slice_threads = max(1, args.workers)
+    upload_threads = 4 if args.upload_in_parallel else 1
+    # a packed upload is a whole piece of work rather than a window
+    max_pending = 2 * slice_threads if args.packed else args.max_pending_windows
+    # downloads are handed on in the order they complete
+    stages = [
+        Stage("slice", slice_files, threads = slice_threads,
+              maxsize = 2 * slice_threads),
+        Stage("upload", upload_packed if args.packed else upload,
+              threads = upload_threads,
+              maxsize = max_pending)]
+    try:
+        uploaded = resumed + run_pipeline(
+                downloader.downloads(work), stages, on_abort=downloader.stop)
+    finally:
+        downloader.close()
+        if ranges is not None:
+            ranges.save()
+        metrics.add("upload", bytes_written=uploader.bytes_uploaded)
+        if pool is not None:
+            pool.terminate()
+        if manifest is not None:
+            manifest.close()
+        shutil.rmtree(staging, ignore_errors=True)
+    tables = {}
+    for sensor in [MC10_SENSOR_NAME, SMARTWATCH_SENSOR_NAME]:
+        cols = curation.columns(sensor)
+        if args.packed:
+            cols.append("window_offset")
+        tables[sensor] = pd.DataFrame(
+                [[window_id, location] + [file_handles.get(col, "") for col in cols]
+                 for s, window_id, location, file_handles in uploaded
+                 if s == sensor],
+                columns = [curation.id_col, "sensor_location"] + cols)
+    tables[SMARTWATCH_SENSOR_NAME] = tables[SMARTWATCH_SENSOR_NAME].drop(
+            "sensor_location", axis=1)
+    return tables[MC10_SENSOR_NAME], tables[SMARTWATCH_SENSOR_NAME]
+
+
+def run_curation(syn, curation, args, cache=None, metrics=None, state=None):
+    """
+    Index (--index-windows), plan (--plan) or curate the windows of
+    `curation`, as `args` ask.
+
+    Returns
+    -------
+    None if the windows were only indexed or planned, otherwise a tuple of
+    pandas DataFrames (mc10, smartwatch, features) as returned by
+    `curate_sensor_measurements`, with features None unless --features
+    """
+    if metrics is None:
+        metrics = stage_metrics.StageMetrics()
+    if args.index_windows is not None:
+        store = window_store.WindowStore(args.index_windows, syn, cache)
+        try:
+            index_windows(syn, curation, store, metrics)
+        finally:
+            store.close()
+        return None
+    if args.plan:
+        plan = plan_run(syn, curation, args, metrics, state)
+        print(run_plan.format_plan(plan, sensor_of = {
+                col: sensor for col, _, _, sensor in curation.streams}))
+        return None
+    features = [] if args.features else None
+    mc10, smartwatch = curate_sensor_measurements(
+            syn, curation, args, cache, metrics, state, features)
+    if features is not None and len(features):
+        features = pd.concat(features, ignore_index=True)
+    elif features is not None:
+        features = empty_features(curation.id_col)
+    return mc10, smartwatch, features
@@ -0,0 +1,82 @@
+'''
+State of incremental curation runs.
+
+The state file records the version of every source file a run read and,
+for every window (task_id or measurement_id), the source files it was
+sliced from. A later run only processes the windows which are new or
+whose source files have a new version, and adds them to the existing
+output tables.
+
+The file is JSON, rewritten once the output tables have been stored, so
+a run which fails partway through leaves the state of the last
+successful run in place.
+'''
+
+import os
+import json
+import tempfile
+
+
+class CurationState(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.windows = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.files = state["files"]
+            self.windows = {window_id: set(syn_ids)
+                            for window_id, syn_ids in state["windows"].items()}
+        self._processed = []
+        self._versions = {}
+
+    def filter_work(self, work, versions):
+        """
+        Drop the windows of `work` (a list of tuples (sensor, files,
+        window_ids)) which were already sliced from the current `versions`
+        of their files, and remember the rest to be recorded by `commit`.
+
+        Parameters
+        ----------
+        work : as returned by curation_pipeline.plan_sensor_work
+        versions : dict with key synapse_id and value the file's version
+
+        Returns
+        -------
+        the remaining work, leaving out items without any windows left
+        """
+        remaining = []
+        for sensor, files, window_ids in work:
+            syn_ids = set(files.values())
+            changed = any(self.files.get(syn_id) != versions[syn_id]
+                          for syn_id in syn_ids)
+            if not changed:
+                window_ids = window_ids[[
+                        not syn_ids <= self.windows.get(str(window_id), set())
+                        for window_id in window_ids]]
+            self._processed.append((syn_ids, list(map(str, window_ids))))
+            if len(window_ids):
+                remaining.append((sensor, files, window_ids))
+        self._versions.update(versions)
+        return remaining
+
+    def commit(self):
+        """
+        Record the work passed to `filter_work` as done and write the state.
+        """
+        for syn_ids, window_ids in self._processed:
+            for syn_id in syn_ids:
+                self.files[syn_id] = self._versions[syn_id]
+            for window_id in window_ids:
+                self.windows.setdefault(window_id, set()).update(syn_ids)
+        self._processed = []
+        state = {"files": self.files,
+                 "windows": {window_id: sorted(syn_ids)
+                             for window_id, syn_ids in self.windows.items()}}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile(
+                "w", dir=directory, delete=False) as f:
+            json.dump(state, f)
+        os.replace(f.name, self.path)
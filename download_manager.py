@@ -0,0 +1,219 @@
+'''
+Downloading the source files of a curation run.
+
+A `DownloadManager` downloads the files of each piece of work on a pool of
+threads and yields the pieces in the order their downloads complete, so
+that slicing starts on whichever file arrives first rather than waiting
+for the slowest. Files count against a disk budget from the moment their
+download starts until they are released, which deletes them, so that
+downloads stay a bounded amount ahead of slicing.
+
+Unless a fixed number of threads is given, the number of concurrent
+downloads is tuned by hill climbing: every `TUNE_INTERVAL` downloads the
+throughput of the last interval is compared with that of the one before,
+and concurrency keeps moving in the same direction while throughput
+improves and turns around once it drops.
+'''
+
+import os
+import time
+import queue
+import shutil
+import tempfile
+import threading
+import stage_metrics
+
+MAX_THREADS = 16
+INITIAL_THREADS = 2
+TUNE_INTERVAL = 4
+
+
+class DownloadManager(object):
+    """
+    Parameters
+    ----------
+    syn : a storage_backend.StorageBackend
+    threads : number of concurrent downloads, or None to tune it between 1
+        and `MAX_THREADS`
+    max_bytes : disk budget of the files downloaded and not yet released,
+        or None for no limit. A piece of work larger than the budget is
+        downloaded once nothing else is on disk.
+    directory : directory to download to. If None, a temporary directory
+        which is removed by `close`.
+    metrics : a stage_metrics.StageMetrics timing the "download" stage
+    """
+
+    def __init__(self, syn, threads=None, max_bytes=None, directory=None,
+                 metrics=None):
+        self.syn = syn
+        self.max_bytes = max_bytes
+        self.tuned = threads is None
+        self.limit = INITIAL_THREADS if threads is None else max(1, threads)
+        self.max_threads = MAX_THREADS if threads is None else self.limit
+        self.temporary = directory is None
+        self.directory = tempfile.mkdtemp() if directory is None else directory
+        os.makedirs(self.directory, exist_ok=True)
+        self.metrics = metrics or stage_metrics.StageMetrics()
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._active = 0
+        self._used = 0
+        self._reserved = {}
+        self._downloaded = {}
+        self._step = 1
+        self._throughput = None
+        self._interval = (time.perf_counter(), 0, 0)
+
+    def downloads(self, work):
+        """
+        Download the files of each item (sensor, files, window_ids) of the
+        list `work`, with files a dict with key column name and value file id.
+
+        Yields
+        ------
+        tuples (sensor, files, window_ids, downloaded) in the order their
+        downloads complete, with downloaded a dict with key column name and
+        value the downloaded file. Pass `files` to `release` once done.
+        """
+        todo = queue.Queue()
+        for item in work:
+            todo.put(item)
+        done = queue.Queue()
+        threads = [threading.Thread(target=self._work, args=(todo, done),
+                                    daemon=True)
+                   for _ in range(min(self.max_threads, max(1, len(work))))]
+        for t in threads:
+            t.start()
+        try:
+            for _ in range(len(work)):
+                # poll, so that a `stop` from another thread ends the wait
+                result = None
+                while result is None and not self._stop.is_set():
+                    try:
+                        result = done.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                if result is None:
+                    return
+                if isinstance(result, Exception):
+                    raise result
+                yield result
+        finally:
+            self.stop()
+
+    def stop(self):
+        """
+        Stop downloading: threads start no further downloads, and
+        `downloads` returns rather than wait for them. Safe to call from
+        any thread.
+        """
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+
+    def _work(self, todo, done):
+        while not self._stop.is_set():
+            try:
+                sensor, files, window_ids = todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                size = sum(self.syn.file_size(files[col]) for col in files)
+                if not self._reserve(files, size):
+                    return
+                try:
+                    start = time.perf_counter()
+                    with self.metrics.stage("download") as counts:
+                        downloaded = {col: self.syn.get(
+                                          files[col], os.path.join(
+                                              self.directory, files[col]))
+                                      for col in files}
+                        counts["bytes_read"] = sum(
+                                os.path.getsize(downloaded[col].path)
+                                for col in downloaded)
+                finally:
+                    with self._cond:
+                        self._active -= 1
+                        self._cond.notify_all()
+                with self._cond:
+                    self._downloaded[key(files)] = [
+                            downloaded[col].path for col in downloaded]
+                    self._completed(counts["bytes_read"],
+                                    time.perf_counter() - start)
+            except Exception as e:
+                done.put(e)
+                return
+            done.put((sensor, files, window_ids, downloaded))
+
+    def _reserve(self, files, size):
+        """
+        Wait for a free download slot and `size` bytes of the budget.
+
+        Returns
+        -------
+        False if the manager was stopped while waiting
+        """
+        with self._cond:
+            while not self._stop.is_set() and not (
+                    self._active < self.limit and (
+                        self.max_bytes is None or self._used == 0 or
+                        self._used + size <= self.max_bytes)):
+                self._cond.wait()
+            if self._stop.is_set():
+                return False
+            self._active += 1
+            self._used += size
+            self._reserved[key(files)] = size
+            return True
+
+    def _completed(self, n_bytes, seconds):
+        # called holding self._cond
+        start, count, total = self._interval
+        count, total = count + 1, total + n_bytes
+        self._interval = (start, count, total)
+        if not self.tuned or count < TUNE_INTERVAL:
+            return
+        now = time.perf_counter()
+        throughput = total / max(now - start, 1e-9)
+        if self._throughput is not None and throughput < self._throughput:
+            self._step = -self._step
+        self.limit = min(max(self.limit + self._step, 1), self.max_threads)
+        self._throughput = throughput
+        self._interval = (now, 0, 0)
+        self._cond.notify_all()
+
+    def release(self, files):
+        """
+        Delete the downloaded `files` (as yielded by `downloads`) and
+        return their space to the budget. Files outside of the download
+        directory, which a backend whose files are already local returns,
+        are left in place.
+        """
+        with self._cond:
+            self._used -= self._reserved.pop(key(files), 0)
+            paths = self._downloaded.pop(key(files), [])
+            self._cond.notify_all()
+        for path in paths:
+            self._remove(path)
+
+    def _remove(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        if os.path.dirname(directory) == os.path.abspath(self.directory):
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def close(self):
+        """
+        Stop downloading and delete every file not yet released.
+        """
+        self.stop()
+        with self._cond:
+            paths = [p for ps in self._downloaded.values() for p in ps]
+            self._downloaded = {}
+        for path in paths:
+            self._remove(path)
+        if self.temporary:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def key(files):
+    return tuple(sorted(files.items()))
@@ -0,0 +1,102 @@
+'''
+Time ranges of source files, to skip files which cannot produce windows.
+
+Which files are relevant to a subject is otherwise decided from the year
+and month in their file name alone, so a monthly smartwatch file is
+downloaded and parsed in full for even a handful of windows, none of which
+may fall inside the timestamps it actually holds.
+
+The index records the first and last timestamp and the number of rows of
+each version of a source file. Ranges are gathered from the timestamps of
+a file as it is sliced (see sensor_io.TimestampRange), so recording them
+reads nothing more of it: source files are not guaranteed to be sorted by
+time, so their first and last rows alone do not bound them. The index is
+JSON, written at the end of each run.
+'''
+
+import os
+import json
+import tempfile
+import threading
+import numpy as np
+
+
+class FileRangeIndex(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.ranges = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.ranges = json.load(f)
+        self._lock = threading.Lock()
+
+    def get(self, file_id, version):
+        """
+        Returns
+        -------
+        tuple (first, last, rows) recorded for `version` of file `file_id`,
+        or None if it is not known
+        """
+        with self._lock:
+            entry = self.ranges.get(file_id)
+        if entry is None or entry["version"] != version:
+            return None
+        return entry["first"], entry["last"], entry["rows"]
+
+    def record(self, file_id, version, first, last, rows):
+        """
+        Record the range (first, last, rows) of `version` of file `file_id`,
+        as a sensor_io.TimestampRange gathers it.
+        """
+        with self._lock:
+            self.ranges[file_id] = {"version": version, "first": first,
+                                    "last": last, "rows": rows}
+
+    def prune(self, work, versions, bounds):
+        """
+        Drop from each item (sensor, files, window_ids) of `work` the files
+        whose known range overlaps none of its windows, and the windows
+        which overlap none of the remaining files.
+
+        Parameters
+        ----------
+        work : as returned by curation_pipeline.plan_sensor_work
+        versions : dict with key file id and value the file's version
+        bounds : dict with key window id and value (start, stop) in integer
+            nanoseconds
+
+        Returns
+        -------
+        the remaining work, leaving out items without any files left
+        """
+        remaining = []
+        for sensor, files, window_ids in work:
+            window_bounds = np.array([bounds[w] for w in window_ids],
+                                     dtype=np.int64).reshape(-1, 2)
+            overlapping = np.zeros(len(window_ids), dtype=bool)
+            relevant_files = {}
+            for col, file_id in files.items():
+                file_range = self.get(file_id, versions[file_id])
+                if file_range is None:
+                    in_range = np.ones(len(window_ids), dtype=bool)
+                elif file_range[2] == 0:
+                    in_range = np.zeros(len(window_ids), dtype=bool)
+                else:
+                    in_range = ((window_bounds[:,0] <= file_range[1]) &
+                                (window_bounds[:,1] >= file_range[0]))
+                if in_range.any():
+                    relevant_files[col] = file_id
+                    overlapping |= in_range
+            if len(relevant_files):
+                remaining.append((sensor, relevant_files, window_ids[overlapping]))
+        return remaining
+
+    def save(self):
+        with self._lock:
+            ranges = dict(self.ranges)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile(
+                "w", dir=directory, delete=False) as f:
+            json.dump(ranges, f)
+        os.replace(f.name, self.path)
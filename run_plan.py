@@ -0,0 +1,186 @@
+'''
+Estimating what a curation run will need before running it.
+
+`estimate` works from the planned work of a run (the source files and the
+windows to slice from each) and the sizes of those files, which the
+storage backend reports without downloading them. Counts of files, windows
+and file handles are exact. Byte counts are estimates:
+
+upload bytes
+    each window is taken to hold its share of the bytes of its source file
+    in proportion to the time it spans, of which a window file takes
+    `WINDOW_PER_BYTE` (`PARSED_PER_BYTE` packed). A file is taken to span
+    its range in a file_ranges.FileRangeIndex if one is recorded, and
+    otherwise the time from the first of its windows to the last, which
+    overestimates sparse windows.
+peak memory
+    the parse of a file peaks at `PARSE_PEAK_PER_BYTE` times its size, and
+    a parsed window takes `PARSED_PER_BYTE` times its share of the file.
+    Each slicing worker is taken to parse the largest file, with the
+    windows of the largest piece of work in memory, while the windows
+    waiting for upload fill their queue: `max_pending_windows` windows,
+    or, packed, twice `slice_threads` of the largest pieces of work.
+temporary disk
+    the largest pieces of work which can be downloaded and not yet sliced
+    at once, within the download budget.
+
+The ratios were measured on float64 sensor files; --float32 and
+--chunksize lower the memory a run actually needs.
+'''
+
+import collections
+import multiprocessing.dummy
+import numpy as np
+import download_manager
+
+PARSE_PEAK_PER_BYTE = 1.7
+PARSED_PER_BYTE = 0.4
+WINDOW_PER_BYTE = 0.6 # window files leave out the id columns of the source
+BASE_RSS = 200 * 2**20 # the interpreter, pandas and the scores table
+
+
+def file_sizes(syn, work, in_parallel=False):
+    """
+    Returns
+    -------
+    dict with key file id and value the size in bytes of each file of
+    `work`, from the backend's metadata
+    """
+    file_ids = sorted({file_id for _, files, _ in work
+                       for file_id in files.values()})
+    if in_parallel:
+        with multiprocessing.dummy.Pool(4) as mp:
+            sizes = mp.map(syn.file_size, file_ids)
+    else:
+        sizes = list(map(syn.file_size, file_ids))
+    return dict(zip(file_ids, sizes))
+
+
+def window_shares(window_bounds, file_range=None):
+    """
+    Returns
+    -------
+    array with the fraction of a file's time range each window of
+    `window_bounds` (an int array (windows, 2) of start and stop) spans.
+    `file_range` is a tuple (first, last, rows) or None if not known.
+    """
+    if file_range is None:
+        first, last = window_bounds[:,0].min(), window_bounds[:,1].max()
+    elif file_range[2] == 0:
+        return np.zeros(len(window_bounds))
+    else:
+        first, last = file_range[0], file_range[1]
+    overlap = (np.minimum(window_bounds[:,1], last) -
+               np.maximum(window_bounds[:,0], first))
+    return np.clip(overlap, 0, None) / max(last - first, 1)
+
+
+def estimate(work, bounds, sizes, ranges=None, versions=None, packed=False,
+             slice_threads=1, download_threads=None, max_bytes=None,
+             max_pending_windows=256):
+    """
+    Parameters
+    ----------
+    work : list of tuples (sensor, files, window_ids), as returned by
+        curation_pipeline.plan_sensor_work
+    bounds : dict with key window id and value (start, stop) in integer
+        nanoseconds
+    sizes : as returned by `file_sizes`
+    ranges : a file_ranges.FileRangeIndex, with `versions` the current
+        version of each file, or None
+    packed, slice_threads, download_threads, max_bytes, max_pending_windows :
+        as the run would be given them (see curation_pipeline and
+        download_manager.DownloadManager)
+
+    Returns
+    -------
+    dict of the estimates, see `format_plan`
+    """
+    files = collections.Counter()
+    file_bytes = collections.Counter()
+    windows = collections.Counter()
+    file_handles = collections.Counter()
+    source_bytes = 0
+    item_bytes, item_peaks, item_windows = [], [], []
+    largest = (0, None)
+    for sensor, item_files, window_ids in work:
+        window_bounds = np.array([bounds[w] for w in window_ids],
+                                 dtype=np.int64).reshape(-1, 2)
+        item_share = 0
+        for col, file_id in item_files.items():
+            file_range = (None if ranges is None
+                          else ranges.get(file_id, versions[file_id]))
+            item_share += sizes[file_id] * window_shares(
+                    window_bounds, file_range).sum()
+            files[col] += 1
+            file_bytes[col] += sizes[file_id]
+            windows[col] += len(window_ids)
+            file_handles[col] += 1 if packed else len(window_ids)
+        source_bytes += item_share
+        sizes_of_item = [sizes[file_id] for file_id in item_files.values()]
+        item_bytes.append(sum(sizes_of_item))
+        item_peaks.append(max(sizes_of_item) * PARSE_PEAK_PER_BYTE +
+                          item_share * PARSED_PER_BYTE)
+        item_windows.append(item_share * PARSED_PER_BYTE)
+        if len(window_ids) > largest[0]:
+            largest = (len(window_ids), sorted(item_files.values()))
+    n_windows = sum(len(window_ids) for _, _, window_ids in work)
+    window_memory = (source_bytes * PARSED_PER_BYTE / n_windows
+                     if n_windows else 0)
+    if packed:
+        # each upload waiting is a whole piece of work
+        pending = sum(sorted(item_windows, reverse=True)[:2 * slice_threads])
+    else:
+        pending = min(max_pending_windows, n_windows) * window_memory
+    peak_rss = BASE_RSS + slice_threads * max(item_peaks, default=0) + pending
+    # downloading, waiting to be sliced and being sliced
+    slots = ((download_threads or download_manager.MAX_THREADS) +
+             3 * slice_threads)
+    item_bytes.sort(reverse=True)
+    temp_disk = sum(item_bytes[:slots])
+    if max_bytes is not None:
+        temp_disk = min(temp_disk, max(max_bytes, max(item_bytes, default=0)))
+    upload_bytes = source_bytes * (PARSED_PER_BYTE if packed
+                                   else WINDOW_PER_BYTE)
+    return {"items": len(work),
+            "packed": packed,
+            "files": dict(files),
+            "file_bytes": dict(file_bytes),
+            "windows": dict(windows),
+            "file_handles": dict(file_handles),
+            "largest_item": {"windows": largest[0], "files": largest[1]},
+            "upload_bytes": int(upload_bytes),
+            "peak_rss_bytes": int(peak_rss),
+            "temp_disk_bytes": int(temp_disk)}
+
+
+def format_plan(plan, sensor_of=None):
+    """
+    Returns
+    -------
+    the estimates of `plan` (as returned by `estimate`) as a table, a line
+    per stream. `sensor_of` maps a stream to its sensor, to note that MC10
+    windows are counted once for all the locations a subject wore.
+    """
+    lines = ["{:<26}{:>8}{:>12}{:>10}{:>14}".format(
+            "stream", "files", "GB", "windows", "file handles")]
+    for col in plan["files"]:
+        note = ""
+        if sensor_of is not None and sensor_of.get(col) == "mc10":
+            note = ("  (windows per location worn)" if plan["packed"]
+                    else "  (per location worn)")
+        lines.append("{:<26}{:>8}{:>12.2f}{:>10}{:>14}{}".format(
+                col, plan["files"][col], plan["file_bytes"][col] / 2**30,
+                plan["windows"][col], plan["file_handles"][col], note))
+    lines += [
+        "download: {:.2f} GB in {} pieces of work".format(
+            sum(plan["file_bytes"].values()) / 2**30, plan["items"]),
+        "largest piece of work: {} windows from {}".format(
+            plan["largest_item"]["windows"],
+            ", ".join(plan["largest_item"]["files"] or [])),
+        "estimated upload: {:.2f} GB".format(plan["upload_bytes"] / 2**30),
+        "estimated peak memory: {:.2f} GB".format(
+            plan["peak_rss_bytes"] / 2**30),
+        "estimated temporary disk: {:.2f} GB".format(
+            plan["temp_disk_bytes"] / 2**30)]
+    return "\n".join(lines)
@@ -0,0 +1,273 @@
+'''
+Reading sensor measurement files downloaded from Synapse.
+
+Parsed measurements can be kept in a `SensorCache`, a local directory of
+sorted, typed columns stored as .npy files. Entries are keyed by the md5
+and version of the Synapse file, so a source file is only ever parsed once,
+and are loaded memory-mapped on later runs. The least recently used entries
+are evicted once the cache grows past its size cap.
+'''
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+import sensor_windows
+
+# bump whenever the parsed representation of a sensor file changes
+CACHE_FORMAT_VERSION = 3
+ID_COLUMNS = ["SubjID", "Location"]
+
+def sensor_dtypes(path, float_dtype=None):
+    """
+    Returns
+    -------
+    dict of the dtypes to read the csv at `path` with: categorical ids and
+    locations and, if `float_dtype` is given, sensor channels of that dtype
+    (e.g. "float32", which halves their memory)
+    """
+    columns = pd.read_csv(path, nrows=0).columns
+    dtypes = {c: "category" for c in ID_COLUMNS if c in columns}
+    if float_dtype is not None:
+        dtypes.update({c: float_dtype for c in columns
+                       if c not in ID_COLUMNS and c != "Timestamp"})
+    return dtypes
+
+
+def parse_sensor_measurement(path, float_dtype=None):
+    """
+    Returns
+    -------
+    a pandas DataFrame indexed by Timestamp, sorted by time or, for MC10
+    measurements (which have a Location column), partitioned by Location
+    (see `sensor_windows.partition_by_location`). Columns are read with
+    `sensor_dtypes`.
+    """
+    sensor_measurement = pd.read_csv(
+            path, dtype=sensor_dtypes(path, float_dtype))
+    sensor_measurement.Timestamp = sensor_windows.parse_timestamps(
+            sensor_measurement.Timestamp)
+    sensor_measurement.set_index("Timestamp", drop = True, inplace=True)
+    sensor_measurement.sort_index(inplace=True)
+    if "Location" in sensor_measurement.columns:
+        sensor_measurement = sensor_windows.partition_by_location(
+                sensor_measurement)
+    return sensor_measurement
+
+
+def read_sensor_measurement(f, cache=None):
+    """
+    Parse the sensor measurement of a Synapse File `f`, going through
+    `cache` when one is given.
+    """
+    float_dtype = getattr(f, "float_dtype", None)
+    if cache is None:
+        return parse_sensor_measurement(f.path, float_dtype)
+    sensor_measurement = cache.load(f)
+    if sensor_measurement is None:
+        sensor_measurement = parse_sensor_measurement(f.path, float_dtype)
+        cache.store(f, sensor_measurement)
+    return sensor_measurement
+
+
+class TimestampRange(object):
+    """
+    The first and last timestamp, in integer nanoseconds, and the number of
+    timestamped rows of a sensor file, gathered from its timestamps as it
+    is parsed rather than by reading it again. first and last are None
+    until a timestamp is seen.
+    """
+
+    def __init__(self):
+        self.first = None
+        self.last = None
+        self.rows = 0
+
+    def update(self, timestamps):
+        timestamps = sensor_windows.to_datetime64(timestamps)
+        ns = timestamps[~np.isnat(timestamps)].view(np.int64)
+        if not len(ns):
+            return
+        first, last = int(ns.min()), int(ns.max())
+        self.first = first if self.first is None else min(self.first, first)
+        self.last = last if self.last is None else max(self.last, last)
+        self.rows += len(ns)
+
+
+def file_md5(path, block_size=2**20):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class SourceFile(object):
+    """
+    The parts of a downloaded Synapse File needed to read and cache it,
+    which unlike the File itself can be sent to other processes.
+
+    Parameters
+    ----------
+    f : a downloaded Synapse File, or another SourceFile
+    float_dtype : dtype to read the sensor channels of `f` with
+    """
+
+    def __init__(self, f, float_dtype=None):
+        self.float_dtype = float_dtype or getattr(f, "float_dtype", None)
+        if isinstance(f, SourceFile):
+            self.path, self.md5, self.version = f.path, f.md5, f.version
+            return
+        file_handle = getattr(f, "_file_handle", None) or {}
+        self.path = f.path
+        self.md5 = (getattr(f, "md5", None) or file_handle.get("contentMd5")
+                    or file_md5(f.path))
+        self.version = getattr(f, "versionNumber", None)
+
+
+def source_key(f):
+    """
+    Returns
+    -------
+    a str identifying the content of Synapse File `f`
+    """
+    f = SourceFile(f)
+    key = "{}-v{}-f{}".format(f.md5, f.version, CACHE_FORMAT_VERSION)
+    if f.float_dtype is not None:
+        key += "-" + f.float_dtype
+    return key
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, i)) for i in os.listdir(path))
+
+
+class SensorCache(object):
+    """
+    Parameters
+    ----------
+    cache_dir : directory to keep parsed sensor measurements in
+    max_bytes : evict least recently used entries beyond this size
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_path(self, f):
+        return os.path.join(self.cache_dir, source_key(f))
+
+    def __contains__(self, f):
+        return os.path.exists(os.path.join(self.entry_path(f), "meta.json"))
+
+    def load(self, f, mmap_mode="r"):
+        """
+        Returns
+        -------
+        the cached pandas DataFrame of `f`, or None if it is not cached
+        """
+        return self.load_key(source_key(f), mmap_mode)
+
+    def load_key(self, key, mmap_mode="r"):
+        """
+        Returns
+        -------
+        the cached pandas DataFrame of the file with `source_key` `key`, or
+        None if it is not cached
+        """
+        entry = self.load_arrays(key, mmap_mode)
+        if entry is None:
+            return None
+        meta, timestamps, values = entry
+        data = {}
+        for col in meta["columns"]:
+            column = values[col["name"]]
+            if col["kind"] in ("object", "category"):
+                column = pd.Categorical.from_codes(
+                        column, categories=col["categories"])
+                if col["kind"] == "object":
+                    column = np.asarray(column, dtype=object)
+            data[col["name"]] = column
+        # copy=False, or pandas reads every memory-mapped column into memory
+        index = pd.DatetimeIndex(timestamps, name=meta["index"], copy=False)
+        sensor_measurement = pd.DataFrame(
+                data, index=index, columns=[c["name"] for c in meta["columns"]],
+                copy=False)
+        return sensor_measurement
+
+    def load_arrays(self, key, mmap_mode="r"):
+        """
+        Returns
+        -------
+        tuple (meta, timestamps, values) of the file with `source_key` `key`,
+        or None if it is not cached. `timestamps` is a datetime64[ns] array
+        and `values` a dict with key column name and value the column as
+        stored, both memory-mapped: non-numeric columns hold the codes of
+        the categories in their entry of meta["columns"].
+        """
+        path = os.path.join(self.cache_dir, key)
+        meta_path = os.path.join(path, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+        os.utime(meta_path) # mark as recently used
+        load = lambda name: np.load(
+                os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+        values = {col["name"]: load(str(i))
+                  for i, col in enumerate(meta["columns"])}
+        return meta, load("index").view("datetime64[ns]"), values
+
+    def store(self, f, sensor_measurement):
+        path = self.entry_path(f)
+        if os.path.exists(path):
+            return
+        staging = tempfile.mkdtemp(dir=self.cache_dir, prefix=".staging-")
+        try:
+            columns = []
+            for i, name in enumerate(sensor_measurement.columns):
+                values = sensor_measurement[name]
+                col = {"name": name, "kind": "numeric"}
+                if str(values.dtype) == "category":
+                    col["kind"] = "category"
+                elif not pd.api.types.is_numeric_dtype(values):
+                    col["kind"] = "object"
+                if col["kind"] != "numeric":
+                    values = values.astype("category")
+                    col["categories"] = values.cat.categories.tolist()
+                    values = values.cat.codes
+                np.save(os.path.join(staging, str(i) + ".npy"), values.values)
+                columns.append(col)
+            index = sensor_measurement.index.values.astype("datetime64[ns]")
+            np.save(os.path.join(staging, "index.npy"), index.view(np.int64))
+            with open(os.path.join(staging, "meta.json"), "w") as meta_file:
+                json.dump({"index": sensor_measurement.index.name,
+                           "columns": columns}, meta_file)
+            os.rename(staging, path)
+        except OSError:
+            # another process stored this entry first
+            shutil.rmtree(staging, ignore_errors=True)
+            if not os.path.exists(path):
+                raise
+        self.evict()
+
+    def evict(self):
+        if self.max_bytes is None:
+            return
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            meta_path = os.path.join(self.cache_dir, name, "meta.json")
+            if not os.path.exists(meta_path):
+                continue
+            entries.append((os.path.getmtime(meta_path), name,
+                            directory_size(os.path.join(self.cache_dir, name))))
+        total = sum(size for _, _, size in entries)
+        for _, name, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+            total -= size
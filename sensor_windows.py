@@ -0,0 +1,367 @@
+'''
+Batch slicing of sensor measurements into task (clinic) or
+diary (at home) windows.
+
+All window start/stop times of a file are converted to row offsets with a
+single `searchsorted` pass over the sorted timestamp array, and the relative
+seconds of every window are computed in one vectorized step. Individual
+windows are then cut as (offset, length) slices of the underlying arrays.
+
+MC10 measurements interleave several body locations. They are partitioned
+by Location once, so that each location's rows are contiguous and sorted by
+time, and a window of a location is a binary search and a slice of that
+partition rather than a scan of the window's rows for each location.
+'''
+
+import numpy as np
+import pandas as pd
+
+MICROSECONDS_PER_SECOND = 1000000
+
+
+def parse_timestamps(timestamps):
+    """
+    Parse timestamp strings, which in the sensor files are ISO 8601, with
+    that format rather than guessing it, falling back to guessing should
+    a file not match it.
+
+    Returns
+    -------
+    a pandas Series of datetime64[ns]
+    """
+    try:
+        parsed = pd.to_datetime(timestamps, format="ISO8601")
+    except ValueError:
+        parsed = pd.to_datetime(timestamps)
+    return parsed.astype("datetime64[ns]")
+
+
+def to_datetime64(t):
+    """
+    Returns
+    -------
+    a numpy datetime64[ns] array of (naive or UTC) times
+    """
+    t = pd.DatetimeIndex(t)
+    if t.tz is not None:
+        t = t.tz_convert(None)
+    return t.values.astype("datetime64[ns]", copy=False)
+
+
+def window_offsets(timestamps, starts, stops):
+    """
+    Locate windows [start, stop] (both inclusive, like label based
+    slicing of a DatetimeIndex) in a sorted timestamp array.
+
+    Returns
+    -------
+    tuple of int arrays (offsets, lengths)
+    """
+    timestamps = to_datetime64(timestamps)
+    offsets = np.searchsorted(timestamps, to_datetime64(starts), side="left")
+    ends = np.searchsorted(timestamps, to_datetime64(stops), side="right")
+    lengths = np.maximum(ends - offsets, 0)
+    return offsets, lengths
+
+
+def gather_windows(offsets, lengths):
+    """
+    Returns
+    -------
+    tuple (rows, bounds) where `rows` are the row numbers of every window
+    laid end to end and window i is `rows[bounds[i]:bounds[i+1]]`
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    bounds = np.concatenate([[0], np.cumsum(lengths)])
+    within = np.arange(bounds[-1]) - np.repeat(bounds[:-1], lengths)
+    rows = np.repeat(offsets, lengths) + within
+    return rows, bounds
+
+
+def relative_seconds(timestamps, bounds):
+    """
+    Seconds elapsed since the first timestamp of each window, the same
+    values `Timedelta.total_seconds` produces.
+
+    Parameters
+    ----------
+    timestamps : datetime64[ns] array of windows laid end to end
+    bounds : window boundaries, as returned by `gather_windows`
+    """
+    ns = timestamps.view(np.int64)
+    lengths = np.diff(bounds)
+    nonempty = lengths > 0
+    time_zero = np.repeat(ns[bounds[:-1][nonempty]], lengths[nonempty])
+    # total_seconds has microsecond resolution
+    microseconds = (ns - time_zero) // 1000
+    seconds, microseconds = np.divmod(microseconds, MICROSECONDS_PER_SECOND)
+    return seconds + microseconds / MICROSECONDS_PER_SECOND
+
+
+def format_location(location):
+    return "_".join(location.split())
+
+
+def window_frame(timestamps, columns, start, stop):
+    """
+    Returns
+    -------
+    a pandas DataFrame with column Timestamp (relative seconds) followed
+    by the sensor columns, for rows [start, stop) of the gathered arrays
+    """
+    data = {"Timestamp": timestamps[start:stop]}
+    for c in columns:
+        data[c] = columns[c][start:stop]
+    return pd.DataFrame(data, columns=["Timestamp"] + list(columns))
+
+
+def partition_by_location(sensor_measurement):
+    """
+    Returns
+    -------
+    `sensor_measurement` (an MC10 measurement indexed by Timestamp) with a
+    categorical Location, whose categories are in order of first
+    appearance, and its rows ordered by Location and then by time
+    """
+    locations = sensor_measurement["Location"].astype("category").values
+    codes = locations.codes
+    locations = locations.set_categories(
+            locations.categories[pd.unique(codes[codes >= 0])])
+    timestamps = to_datetime64(sensor_measurement.index)
+    order = np.lexsort((timestamps, locations.codes))
+    sensor_measurement = sensor_measurement.iloc[order].copy()
+    sensor_measurement["Location"] = locations[order]
+    return sensor_measurement
+
+
+def is_partitioned_by_location(sensor_measurement):
+    locations = sensor_measurement["Location"]
+    if not isinstance(locations.dtype, pd.CategoricalDtype):
+        return False
+    codes = locations.cat.codes.to_numpy()
+    timestamps = to_datetime64(sensor_measurement.index)
+    return bool(np.all((codes[1:] > codes[:-1]) |
+                       ((codes[1:] == codes[:-1]) &
+                        (timestamps[1:] >= timestamps[:-1]))))
+
+
+class LocationPartitions(object):
+    """
+    The timestamps and value columns of an MC10 measurement, partitioned by
+    location. The rows of location `locations[j]` are rows
+    `bounds[j]:bounds[j+1]` of `timestamps` and of each of `values`.
+    """
+
+    def __init__(self, sensor_measurement):
+        if not is_partitioned_by_location(sensor_measurement):
+            sensor_measurement = partition_by_location(sensor_measurement)
+        locations = sensor_measurement["Location"].values
+        self.locations = list(locations.categories)
+        self.bounds = np.searchsorted(
+                locations.codes, np.arange(len(self.locations) + 1), side="left")
+        self.timestamps = to_datetime64(sensor_measurement.index)
+        self.value_cols = [c for c in sensor_measurement.columns
+                           if c not in ["SubjID", "Location"]]
+        self.values = {c: sensor_measurement[c].values for c in self.value_cols}
+
+    def window_offsets(self, starts, stops):
+        """
+        Returns
+        -------
+        tuple of int arrays (offsets, lengths), each of shape
+        (number of windows, number of locations)
+        """
+        starts, stops = to_datetime64(starts), to_datetime64(stops)
+        offsets = np.zeros((len(starts), len(self.locations)), dtype=np.int64)
+        lengths = np.zeros_like(offsets)
+        for j in range(len(self.locations)):
+            begin, end = self.bounds[j], self.bounds[j+1]
+            offsets[:,j], lengths[:,j] = window_offsets(
+                    self.timestamps[begin:end], starts, stops)
+            offsets[:,j] += begin
+        return offsets, lengths
+
+
+def slice_windows(sensor_measurement, window_ids, starts, stops, sensor):
+    """
+    Slice every window out of a sensor measurement at once.
+
+    Parameters
+    ----------
+    sensor_measurement : pandas DataFrame indexed by Timestamp, sorted by
+        time (smartwatch) or partitioned by Location (mc10, see
+        `partition_by_location`, which is applied here otherwise)
+    window_ids : task_id or measurement_id of each window
+    starts, stops : window boundaries (inclusive)
+    sensor : "mc10" or "smartwatch"
+
+    Returns
+    -------
+    a pandas DataFrame indexed by window id with columns
+    sensor_location and sensor_data. The locations of an MC10 window are
+    in the order of their first timestamp in the window.
+    """
+    window_ids = np.asarray(window_ids, dtype=object)
+    result_ids, result_locations, result_data = [], [], []
+    if sensor == "mc10":
+        partitions = LocationPartitions(sensor_measurement)
+        offsets, lengths = partitions.window_offsets(starts, stops)
+        ns = partitions.timestamps.view(np.int64)
+        for i in np.flatnonzero(lengths.sum(axis=1)):
+            located = np.flatnonzero(lengths[i])
+            # order the window's locations by their first timestamp in it
+            located = located[np.argsort(ns[offsets[i,located]], kind="stable")]
+            for j in located:
+                start, stop = offsets[i,j], offsets[i,j] + lengths[i,j]
+                data = {"Timestamp": relative_seconds(
+                    partitions.timestamps[start:stop],
+                    np.array([0, stop - start]))}
+                for c in partitions.value_cols:
+                    data[c] = partitions.values[c][start:stop]
+                result_ids.append(window_ids[i])
+                result_locations.append(format_location(partitions.locations[j]))
+                result_data.append(pd.DataFrame(
+                    data, columns=["Timestamp"] + partitions.value_cols))
+    elif sensor == "smartwatch":
+        timestamps = to_datetime64(sensor_measurement.index)
+        offsets, lengths = window_offsets(timestamps, starts, stops)
+        rows, bounds = gather_windows(offsets, lengths)
+        value_cols = [c for c in sensor_measurement.columns if c != "SubjID"]
+        gathered_cols = {c: sensor_measurement[c].values[rows] for c in value_cols}
+        seconds = relative_seconds(timestamps[rows], bounds)
+        for i in np.flatnonzero(lengths):
+            result_ids.append(window_ids[i])
+            result_locations.append(None)
+            result_data.append(window_frame(
+                seconds, gathered_cols, bounds[i], bounds[i+1]))
+    else:
+        raise TypeError("sensor must be one of mc10 or smartwatch")
+    result = pd.DataFrame(
+            {"sensor_location": result_locations, "sensor_data": result_data},
+            columns=["sensor_location", "sensor_data"],
+            index=pd.Index(result_ids))
+    return result
+
+
+def stream_windows(path, window_ids, starts, stops, sensor, chunksize,
+                   dtype=None, file_range=None):
+    """
+    Read a sensor csv in chunks of `chunksize` rows, keeping only the rows
+    that fall inside a window. Windows are emitted as soon as the file has
+    been read past their stop time, so peak memory depends on the size of
+    the windows rather than on the size of the file. Should the file turn
+    out not to be sorted by time, it is read again from the start with
+    every window held back until the whole file has been read, and each
+    window is emitted again, whole, at the end.
+
+    Yields
+    ------
+    tuple (i, measurements) where `i` is the position of the window in
+    `window_ids` and `measurements` is the `slice_windows` result for it.
+    A later tuple for the same `i` replaces the earlier one. Columns are
+    read with `dtype`, as in `pd.read_csv`. The timestamps of every chunk
+    are added to `file_range`, a sensor_io.TimestampRange, if given.
+    """
+    window_ids = np.asarray(window_ids, dtype=object)
+    starts, stops = to_datetime64(starts), to_datetime64(stops)
+    def read(counted):
+        # the timestamps of the first `counted` chunks are in file_range
+        for n, chunk in enumerate(pd.read_csv(path, chunksize=chunksize,
+                                              dtype=dtype)):
+            chunk.Timestamp = parse_timestamps(chunk.Timestamp)
+            timestamps = to_datetime64(chunk.Timestamp)
+            if file_range is not None and n >= counted:
+                file_range.update(timestamps)
+            yield chunk, timestamps
+    buffers = {}
+    def collect(chunk, timestamps):
+        if len(timestamps) == 0:
+            return
+        chunk_min, chunk_max = timestamps.min(), timestamps.max()
+        overlapping = np.flatnonzero((starts <= chunk_max) & (stops >= chunk_min))
+        for i in overlapping:
+            in_window = (timestamps >= starts[i]) & (timestamps <= stops[i])
+            if in_window.any():
+                buffers.setdefault(i, []).append(chunk[in_window])
+    def emit(i):
+        local_rows = pd.concat(buffers.pop(i), axis=0)
+        local_rows = local_rows.set_index("Timestamp", drop=True)
+        local_rows = local_rows.sort_index(kind="mergesort")
+        return i, slice_windows(local_rows, window_ids[i:i+1],
+                                starts[i:i+1], stops[i:i+1], sensor)
+    chunks = read(0)
+    n_read, previous_max, any_emitted = 0, None, False
+    for chunk, timestamps in chunks:
+        n_read += 1
+        if len(timestamps) == 0:
+            continue
+        if ((previous_max is not None and timestamps.min() < previous_max) or
+                np.any(timestamps[1:] < timestamps[:-1])):
+            break
+        previous_max = timestamps.max()
+        collect(chunk, timestamps)
+        for i in [i for i in buffers if stops[i] < previous_max]:
+            any_emitted = True
+            yield emit(i)
+    else:
+        for i in sorted(buffers):
+            yield emit(i)
+        return
+    # not sorted: windows emitted so far may lack rows of later chunks,
+    # whose earlier rows were not kept
+    if any_emitted:
+        buffers.clear()
+        chunks = read(n_read)
+    else:
+        collect(chunk, timestamps)
+    for chunk, timestamps in chunks:
+        collect(chunk, timestamps)
+    for i in sorted(buffers):
+        yield emit(i)
+
+
+def pack_windows(measurements, window_ids, path):
+    """
+    Write the result of `slice_windows` to a single .npz file, every sensor
+    column laid end to end, which is much cheaper to hand between processes
+    than pickled DataFrames. Windows are referred to by their position in
+    `window_ids`.
+    """
+    window_ids = pd.Index(window_ids)
+    frames = list(measurements.sensor_data)
+    columns = list(frames[0].columns) if len(frames) else []
+    arrays = {
+            "columns": np.asarray(columns, dtype=str),
+            "positions": window_ids.get_indexer(measurements.index),
+            "locations": np.asarray(
+                ["" if l is None else l for l in measurements.sensor_location],
+                dtype=str),
+            "lengths": np.asarray([len(d) for d in frames], dtype=np.int64)}
+    for i, c in enumerate(columns):
+        arrays["column_{}".format(i)] = np.concatenate(
+                [d[c].values for d in frames])
+    np.savez(path, **arrays)
+
+
+def unpack_windows(path, window_ids):
+    """
+    Returns
+    -------
+    the `slice_windows` result written to `path` by `pack_windows`
+    """
+    window_ids = np.asarray(window_ids, dtype=object)
+    with np.load(path) as packed:
+        columns = list(packed["columns"])
+        values = {c: packed["column_{}".format(i)] for i, c in enumerate(columns)}
+        bounds = np.concatenate([[0], np.cumsum(packed["lengths"])])
+        locations = [None if l == "" else l for l in packed["locations"]]
+        positions = packed["positions"]
+    result_data = [pd.DataFrame({c: values[c][start:stop] for c in columns},
+                                columns=columns)
+                   for start, stop in zip(bounds[:-1], bounds[1:])]
+    result = pd.DataFrame(
+            {"sensor_location": locations, "sensor_data": result_data},
+            columns=["sensor_location", "sensor_data"],
+            index=pd.Index(window_ids[positions]))
+    return result
@@ -0,0 +1,104 @@
+'''
+Splitting a curation run across machines.
+
+A run with `--shard i/N` curates the windows of only the subjects whose
+hashed subject_id falls in shard i of N (0 <= i < N), and writes its
+tables to a shard directory instead of storing them. Once all N shards
+have finished, a run with `--merge` combines their tables and stores them.
+
+Shard tables are pickled, so that they keep their dtypes and index (e.g.
+the timestamps of the scores) until they are stored.
+'''
+
+import os
+import glob
+import hashlib
+import argparse
+import tempfile
+import pandas as pd
+
+
+def parse_shard(s):
+    """
+    Parse "i/N" into a tuple (i, N), for use as an argparse type.
+    """
+    try:
+        i, n = map(int, s.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+                "shard must be i/N, e.g. 0/4, got {!r}".format(s))
+    if not 0 <= i < n:
+        raise argparse.ArgumentTypeError(
+                "shard i/N must have 0 <= i < N, got {!r}".format(s))
+    return i, n
+
+
+def shard_of(subject_id, n):
+    """
+    Returns
+    -------
+    the shard (of `n`) of `subject_id`, which is the same in every run.
+    Rows without a subject_id are kept in shard 0.
+    """
+    if pd.isnull(subject_id):
+        return 0
+    digest = hashlib.md5(str(int(subject_id)).encode("utf-8")).hexdigest()
+    return int(digest[:15], 16) % n
+
+
+def in_shard(subject_ids, shard):
+    """
+    Returns
+    -------
+    boolean numpy array, True for the `subject_ids` (a pandas Series) in
+    `shard`, a tuple (i, N)
+    """
+    i, n = shard
+    shards = {subject_id: shard_of(subject_id, n)
+              for subject_id in subject_ids.unique()}
+    return (subject_ids.map(shards) == i).values
+
+
+def shard_path(directory, name, shard):
+    i, n = shard
+    return os.path.join(directory, "{}.shard-{}-of-{}.pkl".format(name, i, n))
+
+
+def write_shard(directory, shard, tables):
+    """
+    Write `tables`, a dict with key table name and value pandas DataFrame,
+    as the tables of `shard`. Each table is written to a temporary file
+    first, so that a shard which failed partway through is not merged.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for name, df in tables.items():
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+            df.to_pickle(f)
+        os.replace(f.name, shard_path(directory, name, shard))
+
+
+def read_shards(directory, names):
+    """
+    Read the tables `names` of every shard in `directory`.
+
+    Returns
+    -------
+    list of pandas DataFrames, the tables of all shards concatenated in
+    the order of `names`
+    """
+    paths = [path for name in names for path in glob.glob(
+                 os.path.join(directory, "{}.shard-*-of-*.pkl".format(name)))]
+    counts = {int(p[:-len(".pkl")].rsplit("-of-", 1)[1]) for p in paths}
+    if len(counts) != 1:
+        raise ValueError("Expected the shards of one run in {}, found shard "
+                         "counts {}".format(directory, sorted(counts)))
+    n = counts.pop()
+    tables = []
+    for name in names:
+        shard_paths = [shard_path(directory, name, (i, n)) for i in range(n)]
+        missing = [i for i, p in enumerate(shard_paths) if not os.path.exists(p)]
+        if missing:
+            raise ValueError("Shards {} of {} of table {} are missing in "
+                             "{}".format(missing, n, name, directory))
+        tables.append(pd.concat([pd.read_pickle(p) for p in shard_paths]))
+    return tables
@@ -0,0 +1,174 @@
+'''
+Per-stage metrics for the curation scripts.
+
+Each stage of a run (listing, downloading, parsing, slicing, merging,
+uploading, storing) is timed with `StageMetrics.stage`, which accumulates
+wall and CPU time, counts of bytes, rows and windows, and the process's
+peak memory, and writes them to a JSON report at the end of the run.
+
+A single stage can additionally be run under cProfile or tracemalloc.
+cProfile only profiles the thread that enables it, so the profile adds up
+the calls of the stage, each in the worker thread that made it, and leaves
+out work a call hands to other threads or processes. Calls of the profiled
+stage are serialized, as one profiler is enabled for one call at a time.
+tracemalloc traces every thread, so calls of the traced stage are
+serialized too, which keeps other calls of the same stage out of its peak.
+CPU time is that of the calling thread, so it does not include work done
+in a process pool.
+'''
+
+import sys
+import json
+import time
+import cProfile
+import resource
+import threading
+import contextlib
+import tracemalloc
+
+COUNTERS = ["bytes_read", "bytes_written", "rows", "windows"]
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StageMetrics(object):
+    """
+    Parameters
+    ----------
+    profile : name of a stage to run under cProfile, whose stats are
+        written to "<stage>.prof"
+    trace_memory : name of a stage to run under tracemalloc
+    progress : print a progress line to stderr as stages complete
+    """
+
+    def __init__(self, profile=None, trace_memory=None, progress=False):
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.progress = progress
+        self.stages = {}
+        self._start = time.perf_counter()
+        self._last_progress = 0
+        self._lock = threading.Lock()
+        self._exclusive = threading.Lock()
+        self._profiler = None
+
+    def _record(self, name):
+        if name not in self.stages:
+            self.stages[name] = dict(
+                    calls = 0, wall_seconds = 0.0, cpu_seconds = 0.0,
+                    first_start = None, last_stop = None, max_rss_mb = 0.0,
+                    **{counter: 0 for counter in COUNTERS})
+        return self.stages[name]
+
+    @contextlib.contextmanager
+    def stage(self, name, **counts):
+        """
+        Time one call of stage `name`. Yields a dict to which the caller
+        can add the counts of `COUNTERS` once they are known, e.g.
+        `counts["rows"] = len(df)`.
+        """
+        counts = dict(counts)
+        exclusive = name in (self.profile, self.trace_memory)
+        if exclusive:
+            self._exclusive.acquire()
+            self._start_tracing(name)
+        start, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield counts
+        finally:
+            stop, cpu = time.perf_counter(), time.thread_time() - cpu
+            peak = self._stop_tracing(name) if exclusive else None
+            if exclusive:
+                self._exclusive.release()
+            self._finish(name, start, stop, cpu, counts, peak)
+
+    def add(self, name, **counts):
+        """
+        Add counts to stage `name` without timing anything.
+        """
+        with self._lock:
+            record = self._record(name)
+            for counter in counts:
+                record[counter] = record.get(counter, 0) + counts[counter]
+
+    def _start_tracing(self, name):
+        if name == self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        if name == self.profile:
+            if self._profiler is None:
+                self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def _stop_tracing(self, name):
+        if name == self.profile:
+            self._profiler.disable()
+        if name == self.trace_memory:
+            return tracemalloc.get_traced_memory()[1] / 2**20
+
+    def _finish(self, name, start, stop, cpu, counts, peak):
+        with self._lock:
+            record = self._record(name)
+            record["calls"] += 1
+            record["wall_seconds"] += stop - start
+            record["cpu_seconds"] += cpu
+            if record["first_start"] is None:
+                record["first_start"] = start
+            record["last_stop"] = stop
+            record["max_rss_mb"] = max(record["max_rss_mb"], max_rss_mb())
+            for counter in counts:
+                record[counter] = record.get(counter, 0) + counts[counter]
+            if peak is not None:
+                record["peak_traced_mb"] = max(
+                        record.get("peak_traced_mb", 0), peak)
+            if self.progress and stop - self._last_progress > 1:
+                self._last_progress = stop
+                sys.stderr.write("\r" + self.progress_line())
+                sys.stderr.flush()
+
+    def progress_line(self):
+        return " | ".join(
+                "{} {} ({:.0f}s)".format(name, s["calls"], s["wall_seconds"])
+                for name, s in self.stages.items())
+
+    def report(self):
+        """
+        Returns
+        -------
+        dict with the totals of the run and, under key "stages", the
+        metrics of each stage. A stage's wall_seconds sums its calls,
+        which overlap when it runs on several threads, while
+        elapsed_seconds is the time from its first call to its last.
+        """
+        with self._lock:
+            stages = {}
+            for name, record in self.stages.items():
+                record = dict(record)
+                first_start = record.pop("first_start")
+                last_stop = record.pop("last_stop")
+                record["elapsed_seconds"] = (
+                        None if first_start is None else last_stop - first_start)
+                stages[name] = record
+        return {"wall_seconds": time.perf_counter() - self._start,
+                "cpu_seconds": time.process_time(),
+                "max_rss_mb": max_rss_mb(),
+                "stages": stages}
+
+    def write(self, path=None):
+        """
+        Write the report to `path` (if given) and the cProfile stats of
+        the profiled stage to "<stage>.prof".
+        """
+        if self.progress:
+            sys.stderr.write("\r" + self.progress_line() + "\n")
+        if self._profiler is not None:
+            self._profiler.dump_stats("{}.prof".format(self.profile))
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        if path is not None:
+            with open(path, "w") as f:
+                json.dump(self.report(), f, indent=2)
@@ -0,0 +1,387 @@
+'''
+Storage backends for the curation scripts.
+
+Every call the curation scripts make to Synapse goes through a backend,
+so that the same pipeline can run against Synapse (`SynapseBackend`) or
+against a local directory (`LocalBackend`), e.g. for profiling and
+benchmarks on machines without network access.
+
+A local backend directory is laid out as
+
+tables/<table id>.csv (or .parquet)
+    tables, queried with "select * from <table id>"
+folders/<parent id>/<file name>
+    folders of sensor measurement files, with file id "<parent id>:<file name>"
+file_handles/<sha256>.<ext>
+    uploaded files, content addressed
+tables/<parent id>/<table name>.csv
+    stored tables, with table id "<parent id>/<table name>"
+'''
+
+import os
+import re
+import shutil
+import threading
+import hashlib
+import numpy as np
+import pandas as pd
+import sensor_io
+
+
+def login(local_root=None):
+    """
+    Returns
+    -------
+    a `LocalBackend` of `local_root` if one is given, otherwise a
+    `SynapseBackend` of a logged in Synapse client
+    """
+    if local_root is not None:
+        return LocalBackend(local_root)
+    import synapseclient as sc
+    return SynapseBackend(sc.login())
+
+
+class StorageBackend(object):
+
+    def query_table(self, query):
+        """
+        Returns
+        -------
+        the result of table query `query` as a pandas DataFrame
+        """
+        raise NotImplementedError
+
+    def get_table_columns(self, table_id):
+        """
+        Returns
+        -------
+        list of dict-like columns with keys id, name and columnType
+        """
+        raise NotImplementedError
+
+    def list_children(self, parent):
+        """
+        Returns
+        -------
+        list of tuples (file name, file id) of the files in folder `parent`
+        """
+        raise NotImplementedError
+
+    def get(self, file_id, directory=None):
+        """
+        Download file `file_id`, to `directory` if given. Backends whose
+        files are already local may read them in place instead.
+
+        Returns
+        -------
+        a downloaded file, with attributes path and versionNumber
+        """
+        raise NotImplementedError
+
+    def file_size(self, file_id):
+        """
+        Returns
+        -------
+        the size in bytes of file `file_id`, without downloading it
+        """
+        raise NotImplementedError
+
+    def upload_file_handle(self, path, mimetype):
+        """
+        Returns
+        -------
+        the id (str) of a new file handle holding the file at `path`
+        """
+        raise NotImplementedError
+
+    def file_version(self, file_id):
+        """
+        Returns
+        -------
+        the current version of file `file_id`, without downloading it
+        """
+        raise NotImplementedError
+
+    def store_table(self, df, parent, name, cols):
+        """
+        Store `df` to a new table `name` under `parent` with columns `cols`,
+        a list of dict-like columns with keys name and columnType (and
+        optionally the other fields of a Synapse column).
+        """
+        raise NotImplementedError
+
+    def create_table(self, parent, name, cols):
+        """
+        Returns
+        -------
+        the id of a new, empty table `name` under `parent`
+        """
+        raise NotImplementedError
+
+    def append_rows(self, table_id, df):
+        raise NotImplementedError
+
+    def table_keys(self, table_id, key_cols):
+        """
+        Returns
+        -------
+        a pandas DataFrame of the `key_cols` of every row of table `table_id`
+        """
+        raise NotImplementedError
+
+    def find_table(self, parent, name):
+        """
+        Returns
+        -------
+        the id of table `name` under `parent`, or None if there is none
+        """
+        raise NotImplementedError
+
+    def upsert_table(self, table_id, df, key_cols):
+        """
+        Append the rows of `df` whose `key_cols` are not yet in table
+        `table_id` and update the rows which are but whose values differ.
+        """
+        raise NotImplementedError
+
+
+def diff_rows(existing, df, key_cols):
+    """
+    Match the rows of `df` to those of `existing` on `key_cols`. Values
+    are compared as strings, with missing values equal to "" and integral
+    floats equal to integers, since a table query may not return the
+    types the table was stored with.
+
+    Returns
+    -------
+    tuple of pandas DataFrames (rows of `df` not in `existing`, rows of
+    `df` which differ from their row in `existing`, indexed like `existing`)
+    """
+    missing = [c for c in df.columns if c not in existing.columns]
+    if len(missing):
+        raise ValueError("The existing table has no columns {}".format(missing))
+    old = existing[list(df.columns)].apply(lambda col: col.map(cell_str))
+    new = df.apply(lambda col: col.map(cell_str))
+    old_keys = pd.MultiIndex.from_frame(old[key_cols])
+    first = ~old_keys.duplicated()
+    indexer = old_keys[first].get_indexer(pd.MultiIndex.from_frame(new[key_cols]))
+    is_new = indexer == -1
+    positions = np.flatnonzero(first)[indexer]
+    changed = np.zeros(len(df), dtype=bool)
+    changed[~is_new] = (old.iloc[positions[~is_new]].to_numpy()
+                        != new[~is_new].to_numpy()).any(axis=1)
+    changed_rows = df[changed].copy()
+    changed_rows.index = existing.index[positions[changed]]
+    return df[is_new], changed_rows
+
+
+def cell_str(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if pd.api.types.is_scalar(value) and pd.isnull(value):
+        return ""
+    return str(value)
+
+
+def synapse_columns(cols):
+    """
+    Returns
+    -------
+    the synapseclient Columns of the dict-like columns `cols`
+    """
+    import synapseclient as sc
+    return [sc.Column(**col) for col in cols]
+
+
+class SynapseBackend(StorageBackend):
+
+    def __init__(self, syn):
+        self.syn = syn
+
+    def query_table(self, query):
+        return self.syn.tableQuery(query).asDataFrame()
+
+    def get_table_columns(self, table_id):
+        return list(self.syn.getTableColumns(table_id))
+
+    def list_children(self, parent):
+        import synapseutils as su
+        _, _, entity_info = list(su.walk(self.syn, parent))[0]
+        return entity_info
+
+    def get(self, file_id, directory=None):
+        if directory is None:
+            return self.syn.get(file_id)
+        return self.syn.get(file_id, downloadLocation=directory,
+                            ifcollision="overwrite.local")
+
+    def file_size(self, file_id):
+        entity = self.syn.get(file_id, downloadFile=False)
+        return entity._file_handle["contentSize"]
+
+    def file_version(self, file_id):
+        return self.syn.get(file_id, downloadFile=False).versionNumber
+
+    def upload_file_handle(self, path, mimetype):
+        return self.syn.uploadSynapseManagedFileHandle(path, mimetype=mimetype)["id"]
+
+    def store_table(self, df, parent, name, cols):
+        import synapseclient as sc
+        schema = sc.Schema(name = name, columns = synapse_columns(cols),
+                           parent = parent)
+        table = sc.Table(schema, df)
+        table = self.syn.store(table)
+        return table
+
+    def create_table(self, parent, name, cols):
+        import synapseclient as sc
+        schema = sc.Schema(name = name, columns = synapse_columns(cols),
+                           parent = parent)
+        return self.syn.store(schema).id
+
+    def append_rows(self, table_id, df):
+        import synapseclient as sc
+        self.syn.store(sc.Table(table_id, df.reset_index(drop=True)))
+
+    def table_keys(self, table_id, key_cols):
+        return self.syn.tableQuery("select {} from {}".format(
+            ", ".join('"{}"'.format(c) for c in key_cols), table_id)).asDataFrame()
+
+    def find_table(self, parent, name):
+        return self.syn.findEntityId(name, parent)
+
+    def upsert_table(self, table_id, df, key_cols):
+        import synapseclient as sc
+        # the index of the query result holds the row ids and versions
+        # which tell Synapse to update rows rather than append them
+        existing = self.syn.tableQuery(
+                "select * from {}".format(table_id)).asDataFrame()
+        new_rows, changed_rows = diff_rows(existing, df, key_cols)
+        if len(changed_rows):
+            self.syn.store(sc.Table(table_id, changed_rows))
+        if len(new_rows):
+            self.syn.store(sc.Table(table_id, new_rows.reset_index(drop=True)))
+        return table_id
+
+
+class LocalFile(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.versionNumber = None
+        self._md5 = None
+
+    @property
+    def md5(self):
+        if self._md5 is None:
+            self._md5 = sensor_io.file_md5(self.path)
+        return self._md5
+
+
+class LocalBackend(StorageBackend):
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        for d in ["tables", "folders", "file_handles"]:
+            os.makedirs(os.path.join(root, d), exist_ok=True)
+
+    def table_path(self, table_id):
+        for ext in [".csv", ".parquet"]:
+            path = os.path.join(self.root, "tables", table_id + ext)
+            if os.path.exists(path):
+                return path
+        raise ValueError("No local table {}".format(table_id))
+
+    def read_table(self, table_id):
+        path = self.table_path(table_id)
+        if path.endswith(".parquet"):
+            return pd.read_parquet(path)
+        return pd.read_csv(path)
+
+    def query_table(self, query):
+        match = re.match(r"\s*select \* from (\S+)(?:\s+limit (\d+))?\s*$",
+                         query, flags=re.IGNORECASE)
+        if match is None:
+            raise ValueError("Only queries of the form \"select * from <id> "
+                             "[limit <n>]\" are supported locally.")
+        df = self.read_table(match.group(1))
+        if match.group(2) is not None:
+            df = df.head(int(match.group(2)))
+        return df
+
+    def get_table_columns(self, table_id):
+        df = self.read_table(table_id)
+        cols = []
+        for i, name in enumerate(df.columns):
+            if pd.api.types.is_integer_dtype(df[name]):
+                column_type = "INTEGER"
+            elif pd.api.types.is_float_dtype(df[name]):
+                column_type = "DOUBLE"
+            else:
+                column_type = "STRING"
+            cols.append({"id": str(i), "name": name, "columnType": column_type})
+        return cols
+
+    def list_children(self, parent):
+        folder = os.path.join(self.root, "folders", parent)
+        return [(fname, "{}:{}".format(parent, fname))
+                for fname in sorted(os.listdir(folder))]
+
+    def get(self, file_id, directory=None):
+        parent, fname = file_id.split(":", 1)
+        return LocalFile(os.path.join(self.root, "folders", parent, fname))
+
+    def file_size(self, file_id):
+        return os.path.getsize(self.get(file_id).path)
+
+    def file_version(self, file_id):
+        stat = os.stat(self.get(file_id).path)
+        return "{}-{}".format(stat.st_size, stat.st_mtime_ns)
+
+    def upload_file_handle(self, path, mimetype):
+        with open(path, "rb") as f:
+            file_handle = hashlib.sha256(f.read()).hexdigest()
+        ext = ".".join(os.path.basename(path).split(".")[1:])
+        destination = os.path.join(
+                self.root, "file_handles", file_handle + "." + ext)
+        if not os.path.exists(destination):
+            shutil.copyfile(path, destination)
+        return file_handle
+
+    def store_table(self, df, parent, name, cols):
+        path = os.path.join(self.root, "tables", parent, name + ".csv")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        df.to_csv(path, index=False)
+        return "{}/{}".format(parent, name)
+
+    def create_table(self, parent, name, cols):
+        return self.store_table(
+                pd.DataFrame(columns=[c["name"] for c in cols]),
+                parent, name, cols)
+
+    def append_rows(self, table_id, df):
+        with self._lock:
+            path = self.table_path(table_id)
+            columns = pd.read_csv(path, nrows=0).columns
+            df[list(columns)].to_csv(path, mode="a", header=False, index=False)
+
+    def table_keys(self, table_id, key_cols):
+        return self.read_table(table_id)[key_cols]
+
+    def find_table(self, parent, name):
+        table_id = "{}/{}".format(parent, name)
+        try:
+            self.table_path(table_id)
+        except ValueError:
+            return None
+        return table_id
+
+    def upsert_table(self, table_id, df, key_cols):
+        existing = self.read_table(table_id)
+        new_rows, changed_rows = diff_rows(existing, df, key_cols)
+        existing = existing.astype(object)
+        existing.loc[changed_rows.index, changed_rows.columns] = changed_rows
+        existing = pd.concat([existing, new_rows], ignore_index=True)
+        existing.to_csv(self.table_path(table_id), index=False)
+        return table_id
@@ -0,0 +1,132 @@
+'''
+Storing DataFrames to tables, appending large ones in chunks.
+
+Rather than one request holding every row, which a single timeout throws
+away, rows are appended in chunks of a fixed number of rows, a few chunks
+at a time, and a failing chunk is retried with exponential backoff. Rows
+are identified by key columns (e.g. task_id and sensor_location), so that
+rows an earlier, interrupted attempt already stored are not stored again.
+'''
+
+import time
+import random
+import multiprocessing.dummy
+import pandas as pd
+import storage_backend
+import stage_metrics
+
+RETRIES = 5
+BACKOFF_SECONDS = 2
+
+
+def key_index(df, key_cols):
+    """
+    Returns
+    -------
+    a pandas MultiIndex of the `key_cols` of `df`, compared as strings
+    like `storage_backend.diff_rows` compares rows
+    """
+    return pd.MultiIndex.from_frame(
+            df[key_cols].apply(lambda col: col.map(storage_backend.cell_str)))
+
+
+def stored_keys(syn, table_id, key_cols):
+    """
+    Returns
+    -------
+    the `key_index` of the rows in table `table_id`
+    """
+    return key_index(syn.table_keys(table_id, key_cols), key_cols)
+
+
+def unstored_rows(df, key_cols, keys):
+    """
+    Returns
+    -------
+    the rows of `df` whose `key_cols` are not in `keys`
+    """
+    if len(keys) == 0:
+        return df
+    return df[~key_index(df, key_cols).isin(keys)]
+
+
+def append_in_chunks(syn, table_id, df, key_cols, batch_size, threads=1,
+                     skip_stored=True):
+    """
+    Append the rows of `df` to table `table_id` in chunks of `batch_size`
+    rows, `threads` chunks at a time.
+
+    Parameters
+    ----------
+    syn : a storage_backend.StorageBackend
+    key_cols : columns identifying a row
+    skip_stored : leave out the rows already in the table, e.g. stored by an
+        earlier attempt; skip this check for a table which was just created
+
+    Returns
+    -------
+    the number of rows appended
+    """
+    if skip_stored:
+        df = unstored_rows(df, key_cols, stored_keys(syn, table_id, key_cols))
+    chunks = [df.iloc[i:i+batch_size] for i in range(0, len(df), batch_size)]
+    append = lambda chunk: append_chunk(syn, table_id, chunk, key_cols)
+    if threads > 1:
+        with multiprocessing.dummy.Pool(threads) as mp:
+            appended = mp.map(append, chunks)
+    else:
+        appended = list(map(append, chunks))
+    return sum(appended)
+
+
+def append_chunk(syn, table_id, chunk, key_cols):
+    """
+    Append `chunk` to table `table_id`, retrying up to `RETRIES` times with
+    exponential backoff. A request which failed may still have stored the
+    chunk, so before each retry the rows already in the table are removed
+    from it.
+
+    Returns
+    -------
+    the number of rows appended
+    """
+    for attempt in range(RETRIES + 1):
+        try:
+            syn.append_rows(table_id, chunk)
+            return len(chunk)
+        except Exception:
+            if attempt == RETRIES:
+                raise
+            time.sleep(BACKOFF_SECONDS * 2**attempt * random.uniform(0.5, 1.5))
+            chunk = unstored_rows(
+                    chunk, key_cols, stored_keys(syn, table_id, key_cols))
+            if len(chunk) == 0:
+                return 0
+
+
+def store_dataframe(syn, df, parent, name, cols, metrics=None,
+                    key_cols=None, upsert=False, batch_size=None, threads=1):
+    """
+    Store `df` to table `name` under `parent`.
+
+    With `upsert`, the rows of an existing table are appended and updated,
+    keyed on `key_cols`. Otherwise, given a `batch_size`, rows are appended
+    in chunks, `threads` at a time (see `append_in_chunks`), leaving out the
+    rows an earlier attempt already stored.
+    """
+    if metrics is None:
+        metrics = stage_metrics.StageMetrics()
+    with metrics.stage("store", rows=len(df)):
+        table_id = None
+        if upsert or batch_size is not None:
+            table_id = syn.find_table(parent, name)
+        if upsert and table_id is not None:
+            table = syn.upsert_table(table_id, df, key_cols)
+        elif batch_size is None:
+            table = syn.store_table(df, parent, name, cols)
+        else:
+            table = table_id or syn.create_table(parent, name, cols)
+            append_in_chunks(
+                    syn, table, df, key_cols, batch_size, threads,
+                    skip_stored = table_id is not None)
+    return table
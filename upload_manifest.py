@@ -0,0 +1,120 @@
+'''
+A persistent record of uploaded windows, so that a curation run which
+fails partway through can be restarted without uploading again every
+window that already has a file handle.
+
+The manifest is a SQLite database with two tables:
+
+windows
+    key -> file handle id, written as soon as each upload completes
+items
+    key of a piece of work (a group of source files at their versions) ->
+    the bounds of the windows it was asked for and the windows it produced,
+    written once all of them are uploaded. Windows asked for again are
+    added to the item, so that a run sampling fewer windows than an earlier
+    one does not make the earlier windows be curated again.
+'''
+
+import json
+import sqlite3
+import threading
+
+
+class UploadManifest(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS windows "
+                             "(key TEXT PRIMARY KEY, file_handle TEXT)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS items "
+                             "(key TEXT PRIMARY KEY, windows TEXT)")
+
+    def get(self, key):
+        """
+        Returns
+        -------
+        the file handle id recorded for window `key`, or None
+        """
+        with self._lock:
+            row = self._db.execute(
+                    "SELECT file_handle FROM windows WHERE key = ?",
+                    (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def record(self, key, file_handle):
+        with self._lock, self._db:
+            self._db.execute(
+                    "INSERT OR REPLACE INTO windows VALUES (?, ?)",
+                    (key, file_handle))
+
+    def completed_item(self, key):
+        """
+        Returns
+        -------
+        tuple (requested, windows) of the bounds of the windows item `key`
+        was asked for and the list of windows it produced, or None if the
+        item has not been completed
+        """
+        with self._lock:
+            row = self._db.execute(
+                    "SELECT windows FROM items WHERE key = ?",
+                    (key,)).fetchone()
+        if row is None:
+            return None
+        item = json.loads(row[0])
+        return item["requested"], item["windows"]
+
+    def complete_item(self, key, requested, windows):
+        """
+        Record that item `key` produced `windows` for the window bounds of
+        `requested`, in addition to what it is already recorded to have
+        produced.
+        """
+        with self._lock, self._db:
+            row = self._db.execute(
+                    "SELECT windows FROM items WHERE key = ?",
+                    (key,)).fetchone()
+            if row is not None:
+                item = json.loads(row[0])
+                # windows are identified by their bounds and location
+                produced = {tuple(w[:3]): w for w in item["windows"]}
+                produced.update((tuple(w[:3]), w) for w in windows)
+                windows = list(produced.values())
+                requested = sorted(set(map(tuple, item["requested"])) |
+                                   set(map(tuple, requested)))
+            self._db.execute(
+                    "INSERT OR REPLACE INTO items VALUES (?, ?)",
+                    (key, json.dumps({"requested": requested,
+                                      "windows": windows})))
+
+    def begin_item(self, key, requested, n_windows):
+        """
+        Start tracking item `key`, asked for the window bounds of
+        `requested` (a list of [start, stop]), which is complete once
+        `finish_window` has been called for each of its `n_windows`
+        windows.
+        """
+        if n_windows == 0:
+            self.complete_item(key, requested, [])
+        else:
+            with self._lock:
+                self._pending[key] = [n_windows, requested, []]
+
+    def finish_window(self, item_key, window):
+        with self._lock:
+            state = self._pending[item_key]
+            state[0] -= 1
+            state[2].append(window)
+            if state[0] == 0:
+                del self._pending[item_key]
+        if state[0] == 0:
+            self.complete_item(item_key, state[1], state[2])
+
+    def close(self):
+        with self._lock:
+            self._db.close()
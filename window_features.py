@@ -0,0 +1,160 @@
+'''
+Activity index and tremor band features of sliced accelerometer windows.
+
+Features are computed on the windows in memory during curation, in NumPy
+across the epochs of a batch of windows at once, rather than by
+downloading and parsing every window again in R (activity_index_features.R,
+tremor_features.R). Each window is split into one-minute epochs, the
+last of which may be shorter, as in those scripts.
+
+The activity index of an epoch (Bai et al., as computed by the R package
+ActivityIndex) is
+
+    sqrt(max((mean over axes of the variance - SIGMA_0**2) / SIGMA_0**2, 0))
+
+Tremor features are taken from the power spectrum of each linearly
+detrended epoch, summed over the axes: the power in `TREMOR_BAND` and in
+`FREQUENCY_FILTER`, their ratio, and the frequency of the spectral peak
+within `FREQUENCY_FILTER`.
+'''
+
+import numpy as np
+import pandas as pd
+
+SIGMA_0 = 0.0025 # synchronize with activity_index_features.R
+EPOCH_SECONDS = 60
+FREQUENCY_FILTER = (1, 25) # Hz, synchronize with tremor_features.R
+TREMOR_BAND = (3.5, 7.5) # Hz
+MIN_SPECTRUM_SECONDS = 5 # shorter epochs get no tremor features
+AXES = ["X", "Y", "Z"]
+FEATURE_COLUMNS = ["epoch", "epoch_start", "activity_index", "tremor_power",
+                   "total_power", "tremor_power_ratio", "dominant_frequency"]
+
+
+def sampling_rate(timestamps):
+    """
+    Returns
+    -------
+    samples per second of `timestamps` (in seconds) rounded to the nearest
+    integer, or 0 if they span no time. Unlike the rate
+    activity_index_features.R rounds up from the number of samples per
+    second of duration, this does not overshoot by one sample per second.
+    """
+    duration = timestamps[-1] - timestamps[0] if len(timestamps) else 0
+    if duration <= 0:
+        return 0
+    return int(round((len(timestamps) - 1) / duration))
+
+
+def window_features(windows):
+    """
+    Parameters
+    ----------
+    windows : list of DataFrames with columns Timestamp (in seconds) and
+        `AXES`
+
+    Returns
+    -------
+    pandas DataFrame with a row for each epoch of each window, with column
+    window (the position of the window in `windows`) and `FEATURE_COLUMNS`.
+    Epochs are numbered from 1 within each window.
+    """
+    values, window, epoch, epoch_start, lengths, rates = [], [], [], [], [], []
+    for i, df in enumerate(windows):
+        timestamps = df.Timestamp.values
+        rate = sampling_rate(timestamps)
+        # drop the samples of the last, incomplete second
+        n = len(df) - len(df) % rate if rate else 0
+        if n < 2:
+            continue
+        epoch_length = EPOCH_SECONDS * rate
+        starts = np.arange(0, n, epoch_length)
+        x = df[AXES].values[:n].astype(np.float64)
+        values.append(x - x.mean(axis=0))
+        window.append(np.full(len(starts), i))
+        epoch.append(np.arange(1, len(starts) + 1))
+        epoch_start.append(timestamps[starts])
+        lengths.append(np.diff(np.append(starts, n)))
+        rates.append(np.full(len(starts), rate))
+    if not len(values):
+        return pd.DataFrame(columns=["window"] + FEATURE_COLUMNS)
+    values = np.concatenate(values)
+    lengths, rates = np.concatenate(lengths), np.concatenate(rates)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    features = pd.DataFrame({
+            "window": np.concatenate(window),
+            "epoch": np.concatenate(epoch),
+            "epoch_start": np.concatenate(epoch_start),
+            "activity_index": activity_index(values, offsets, lengths)})
+    tremor = tremor_features(values, offsets, lengths, rates)
+    for c in tremor:
+        features[c] = tremor[c]
+    return features[["window"] + FEATURE_COLUMNS]
+
+
+def activity_index(values, offsets, lengths):
+    """
+    Returns
+    -------
+    the activity index of each epoch of `values`, the epoch starting at
+    row offsets[i] being lengths[i] rows long
+    """
+    sums = np.add.reduceat(values, offsets, axis=0)
+    squares = np.add.reduceat(values**2, offsets, axis=0)
+    n = lengths[:, np.newaxis]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = (squares - sums**2 / n) / (n - 1)
+    ai = (variance.mean(axis=1) - SIGMA_0**2) / SIGMA_0**2
+    return np.sqrt(np.maximum(ai, 0))
+
+
+def tremor_features(values, offsets, lengths, rates):
+    """
+    Returns
+    -------
+    dict with key feature name and value an array with the feature of each
+    epoch (NaN for epochs shorter than `MIN_SPECTRUM_SECONDS`). Epochs of
+    the same length and sampling rate are transformed together.
+    """
+    n_epochs = len(lengths)
+    features = {c: np.full(n_epochs, np.nan) for c in
+                ["tremor_power", "total_power", "tremor_power_ratio",
+                 "dominant_frequency"]}
+    groups = pd.DataFrame({"length": lengths, "rate": rates})
+    groups = groups[groups.length >= MIN_SPECTRUM_SECONDS * groups.rate]
+    for (length, rate), group in groups.groupby(["length", "rate"]):
+        epochs = group.index.values
+        x = values[offsets[epochs][:, np.newaxis] + np.arange(length)]
+        x = detrend(x)
+        # one-sided power, in units of variance
+        power = (np.abs(np.fft.rfft(x, axis=1))**2).sum(axis=2) * 2 / length**2
+        frequencies = np.fft.rfftfreq(length, 1 / rate)
+        in_filter = ((frequencies >= FREQUENCY_FILTER[0]) &
+                     (frequencies <= FREQUENCY_FILTER[1]))
+        in_band = ((frequencies >= TREMOR_BAND[0]) &
+                   (frequencies <= TREMOR_BAND[1]))
+        if not in_filter.any():
+            continue
+        total = power[:, in_filter].sum(axis=1)
+        tremor = power[:, in_band].sum(axis=1)
+        features["total_power"][epochs] = total
+        features["tremor_power"][epochs] = tremor
+        with np.errstate(divide="ignore", invalid="ignore"):
+            features["tremor_power_ratio"][epochs] = np.where(
+                    total > 0, tremor / total, np.nan)
+        features["dominant_frequency"][epochs] = frequencies[in_filter][
+                power[:, in_filter].argmax(axis=1)]
+    return features
+
+
+def detrend(x):
+    """
+    Returns
+    -------
+    `x`, an array (epochs, samples, axes), less the least squares line
+    through each epoch and axis
+    """
+    t = np.arange(x.shape[1]) - (x.shape[1] - 1) / 2
+    slope = np.einsum("j,ijk->ik", t, x) / (t**2).sum()
+    return (x - x.mean(axis=1, keepdims=True)
+              - slope[:, np.newaxis, :] * t[np.newaxis, :, np.newaxis])
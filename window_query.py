@@ -0,0 +1,124 @@
+'''
+Selecting which windows a curation run slices, before anything is
+downloaded.
+
+The work of a run is planned from the scores (or diary) table alone, as a
+list of source files and the windows to slice from them. A `WindowQuery`
+narrows that list down to the windows of some subjects, tasks or dates and
+to a deterministic sample of them, and drops the files left without any
+windows, so that a smoke run on 2% of the windows or the re-curation of a
+single subject downloads and slices only what it stores.
+
+Windows are sampled by window id (task_id or measurement_id), so that the
+sensor locations of a window are kept or dropped together, and the same
+windows are sampled in every run.
+'''
+
+import argparse
+import hashlib
+import pandas as pd
+
+
+def parse_ids(s):
+    """
+    Parse a comma separated list of subject ids, for use as an argparse type.
+    """
+    try:
+        return [int(i) for i in s.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+                "expected comma separated integers, e.g. 1004,1016, "
+                "got {!r}".format(s))
+
+
+def parse_date(s):
+    """
+    Parse a date or timestamp into integer nanoseconds, for use as an
+    argparse type.
+    """
+    try:
+        return pd.Timestamp(s).value
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+                "expected a date, e.g. 2019-05-01, got {!r}".format(s))
+
+
+def keep_sample(key, frac):
+    """
+    Deterministically keep a fraction `frac` of keys, so that every piece of
+    work sharing a key (e.g. the modalities of a window) is kept or dropped
+    together without first collecting all of them.
+    """
+    if frac >= 1:
+        return True
+    digest = hashlib.md5(str(key).encode("utf-8")).hexdigest()
+    return int(digest[:15], 16) < frac * 16**15
+
+
+class WindowQuery(object):
+    """
+    Parameters
+    ----------
+    subjects : list of the subject ids to keep, or None for all
+    tasks : list of the task codes to keep, or None for all
+    start : keep the windows starting at or after this time in integer
+        nanoseconds, or None
+    end : keep the windows starting before this time in integer
+        nanoseconds, or None
+    frac : fraction of the remaining windows to keep
+    """
+
+    def __init__(self, subjects=None, tasks=None, start=None, end=None,
+                 frac=1):
+        self.subjects = subjects
+        self.tasks = tasks
+        self.start = start
+        self.end = end
+        self.frac = frac
+
+    def select(self, table, bounds, task_col=None):
+        """
+        Parameters
+        ----------
+        table : the scores or diary table, indexed by window id, with
+            column subject_id
+        bounds : dict with key window id and value (start, stop) in integer
+            nanoseconds
+        task_col : column of `table` holding the task code, or None if
+            windows have no task
+
+        Returns
+        -------
+        set of the window ids selected
+        """
+        keep = pd.Series(True, index=table.index)
+        if self.subjects is not None:
+            keep &= table.subject_id.isin(self.subjects)
+        if self.tasks is not None:
+            if task_col is None:
+                raise ValueError("These windows cannot be selected by task")
+            keep &= table[task_col].isin(self.tasks)
+        if self.start is not None or self.end is not None:
+            starts = table.index.map(lambda window_id: bounds[window_id][0])
+            if self.start is not None:
+                keep &= starts >= self.start
+            if self.end is not None:
+                keep &= starts < self.end
+        return {window_id for window_id in table.index[keep.values]
+                if keep_sample(window_id, self.frac)}
+
+    def filter_work(self, work, selected):
+        """
+        Drop the windows of `work` (a list of tuples (sensor, files,
+        window_ids)) which are not `selected`.
+
+        Returns
+        -------
+        the remaining work, leaving out items without any windows left
+        """
+        remaining = []
+        for sensor, files, window_ids in work:
+            window_ids = window_ids[window_ids.isin(selected)]
+            if len(window_ids):
+                remaining.append((sensor, files, window_ids))
+        return remaining
@@ -0,0 +1,203 @@
+'''
+Serializing sliced windows and uploading them as Synapse file handles.
+
+Windows are written to an in-memory buffer, optionally compressed, and
+deduplicated by content hash so that identical windows share a single
+file handle instead of being uploaded again.
+
+Alternatively, all windows of a piece of work (e.g. a subject's MC10
+recording) can be packed into a single .npz container per modality, whose
+windows are then referred to by (file handle, window offset).
+'''
+
+import io
+import gzip
+import hashlib
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+
+COMPRESSIONS = { # compression: (file suffix, mimetype)
+        None: (".csv", "text/csv"),
+        "gzip": (".csv.gz", "application/gzip"),
+        "zstd": (".csv.zst", "application/zstd")}
+PACKED = (".npz", "application/octet-stream") # file suffix, mimetype
+
+
+def serialize_window(df, compression=None, float_format=None):
+    """
+    Returns
+    -------
+    the bytes of `df` as a csv, compressed with `compression`
+    """
+    if compression not in COMPRESSIONS:
+        raise TypeError("compression must be one of {}".format(
+            list(COMPRESSIONS)))
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, float_format=float_format)
+    data = buffer.getvalue().encode("utf-8")
+    if compression == "gzip":
+        # mtime=0 so that identical windows compress to identical bytes
+        data = gzip.compress(data, compresslevel=6, mtime=0)
+    elif compression == "zstd":
+        import zstandard # optional, only needed for zstd compression
+        data = zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def pack_windows(windows, window_keys, compressed=False):
+    """
+    Pack `windows`, a list of DataFrames with the same numeric columns (any
+    other value being a missing window), into a single .npz container with
+    every column laid end to end. Window i is rows offsets[i]:offsets[i+1]
+    of each array "column_<j>", identified by window_ids[i] and
+    locations[i].
+
+    Parameters
+    ----------
+    window_keys : list of tuples (window_id, location), one per window
+    compressed : deflate the arrays
+
+    Returns
+    -------
+    the bytes of the container
+    """
+    frames = [d for d in windows if isinstance(d, pd.DataFrame)]
+    columns = list(frames[0].columns) if len(frames) else []
+    lengths = [len(d) if isinstance(d, pd.DataFrame) else 0 for d in windows]
+    arrays = {
+            "columns": np.asarray(columns, dtype=str),
+            "window_ids": np.asarray([str(w) for w, _ in window_keys], dtype=str),
+            "locations": np.asarray(
+                ["" if l is None else l for _, l in window_keys], dtype=str),
+            "present": np.asarray(
+                [isinstance(d, pd.DataFrame) for d in windows], dtype=bool),
+            "offsets": np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])}
+    for i, c in enumerate(columns):
+        arrays["column_{}".format(i)] = np.concatenate(
+                [d[c].values for d in frames])
+    buffer = io.BytesIO()
+    (np.savez_compressed if compressed else np.savez)(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def unpack_window(packed, offset):
+    """
+    Parameters
+    ----------
+    packed : a container written by `pack_windows`, as a path or as opened
+        by `numpy.load`
+    offset : position of the window in the container
+
+    Returns
+    -------
+    the window as a DataFrame, or None if it is missing
+    """
+    if not isinstance(packed, np.lib.npyio.NpzFile):
+        with np.load(packed) as f:
+            return unpack_window(f, offset)
+    if not packed["present"][offset]:
+        return None
+    start, stop = packed["offsets"][offset:offset+2]
+    columns = list(packed["columns"])
+    return pd.DataFrame(
+            {c: packed["column_{}".format(i)][start:stop]
+             for i, c in enumerate(columns)},
+            columns=columns)
+
+
+class FileHandleUploader(object):
+    """
+    Uploads windows as file handles, reusing the file handle of any
+    identical window uploaded before.
+
+    Parameters
+    ----------
+    syn : a storage_backend.StorageBackend
+    compression : one of the keys of `COMPRESSIONS`
+    float_format : passed to `DataFrame.to_csv`, e.g. "%.6f"
+    """
+
+    def __init__(self, syn, compression=None, float_format=None):
+        self.syn = syn
+        self.compression = compression
+        self.float_format = float_format
+        self.file_handles = {}
+        self.bytes_uploaded = 0
+        self._lock = threading.Lock()
+
+    def upload(self, df):
+        """
+        Returns
+        -------
+        the file handle id (str) of `df`, or "" if `df` is not a DataFrame
+        """
+        if not isinstance(df, pd.DataFrame):
+            return ""
+        data = serialize_window(df, self.compression, self.float_format)
+        return self._upload(data, *COMPRESSIONS[self.compression])
+
+    def upload_packed(self, windows, window_keys):
+        """
+        Upload `windows` packed into a single container (see `pack_windows`),
+        compressed if this uploader compresses.
+
+        Returns
+        -------
+        the file handle id (str) of the container, or "" if none of
+        `windows` is a DataFrame
+        """
+        if not any(isinstance(d, pd.DataFrame) for d in windows):
+            return ""
+        data = pack_windows(windows, window_keys,
+                            compressed = self.compression is not None)
+        return self._upload(data, *PACKED)
+
+    def _upload(self, data, suffix, mimetype):
+        content_hash = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            pending = self.file_handles.get(content_hash)
+            if pending is None:
+                pending = self.file_handles[content_hash] = _PendingUpload()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return pending.wait()
+        try:
+            with tempfile.NamedTemporaryFile(suffix=suffix) as f:
+                f.write(data)
+                f.flush()
+                file_handle = self.syn.upload_file_handle(f.name, mimetype)
+        except Exception as e:
+            with self._lock:
+                del self.file_handles[content_hash]
+            pending.fail(e)
+            raise
+        with self._lock:
+            self.bytes_uploaded += len(data)
+        pending.done(file_handle)
+        return file_handle
+
+
+class _PendingUpload(object):
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._file_handle = None
+        self._error = None
+
+    def done(self, file_handle):
+        self._file_handle = file_handle
+        self._event.set()
+
+    def fail(self, error):
+        self._error = error
+        self._event.set()
+
+    def wait(self):
+        self._event.wait()
+        if self._error is not None:
+            raise self._error
+        return self._file_handle
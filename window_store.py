@@ -0,0 +1,184 @@
+'''
+Reading individual windows on demand, without curating them.
+
+A `WindowStore` keeps an index which resolves a window, given its id
+(task_id or measurement_id), modality (e.g. mc10_accelerometer) and sensor
+location, to a source file and the rows the window spans in that file's
+parsed representation in a sensor_io.SensorCache. `get` reads only those
+rows of the memory-mapped cache entry, downloading and parsing the source
+file first should it not be cached, and keeps the most recently read
+windows in memory.
+
+The index is a SQLite database with two tables:
+
+sources
+    file id -> the sensor_io.source_key and float dtype of the file it
+    was built from
+windows
+    (window id, modality, location) -> file id and row range [start, stop)
+
+It is built with `add_windows` from the window bounds the curation
+scripts slice (see curation_pipeline.index_windows), so that `get`
+returns the windows they would upload.
+'''
+
+import sqlite3
+import threading
+import collections
+import numpy as np
+import sensor_io
+import sensor_windows
+
+
+class WindowStore(object):
+    """
+    Parameters
+    ----------
+    path : SQLite file holding the index
+    syn : a storage_backend.StorageBackend to download source files from
+    cache : a sensor_io.SensorCache of parsed source files
+    max_windows : number of windows kept in memory
+    max_sources : number of memory-mapped source files kept open
+    """
+
+    def __init__(self, path, syn, cache, max_windows=256, max_sources=8):
+        self.path = path
+        self.syn = syn
+        self.cache = cache
+        self.max_windows = max_windows
+        self.max_sources = max_sources
+        self._windows = collections.OrderedDict()
+        self._sources = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS sources "
+                             "(file_id TEXT PRIMARY KEY, source_key TEXT, "
+                             "float_dtype TEXT)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS windows "
+                             "(window_id TEXT, modality TEXT, location TEXT, "
+                             "file_id TEXT, start INTEGER, stop INTEGER, "
+                             "PRIMARY KEY (window_id, modality, location))")
+
+    def add_windows(self, f, file_id, modality, window_ids, starts, stops,
+                    sensor):
+        """
+        Index the windows [start, stop] of source file `f` (downloaded from
+        `file_id`), parsing it into the cache unless it is cached already.
+
+        Returns
+        -------
+        the number of windows indexed
+        """
+        sensor_measurement = sensor_io.read_sensor_measurement(f, self.cache)
+        window_ids = [str(w) for w in window_ids]
+        rows = []
+        if sensor == "mc10":
+            partitions = sensor_windows.LocationPartitions(sensor_measurement)
+            offsets, lengths = partitions.window_offsets(starts, stops)
+            for i, j in zip(*np.nonzero(lengths)):
+                rows.append((window_ids[i], modality,
+                             sensor_windows.format_location(
+                                 partitions.locations[j]),
+                             file_id, int(offsets[i,j]),
+                             int(offsets[i,j] + lengths[i,j])))
+        elif sensor == "smartwatch":
+            offsets, lengths = sensor_windows.window_offsets(
+                    sensor_measurement.index, starts, stops)
+            for i in np.flatnonzero(lengths):
+                rows.append((window_ids[i], modality, "", file_id,
+                             int(offsets[i]), int(offsets[i] + lengths[i])))
+        else:
+            raise TypeError("sensor must be one of mc10 or smartwatch")
+        with self._lock, self._db:
+            self._db.execute(
+                    "INSERT OR REPLACE INTO sources VALUES (?, ?, ?)",
+                    (file_id, sensor_io.source_key(f),
+                     getattr(f, "float_dtype", None)))
+            self._db.executemany(
+                    "INSERT OR REPLACE INTO windows VALUES (?, ?, ?, ?, ?, ?)",
+                    rows)
+        return len(rows)
+
+    def keys(self, window_id):
+        """
+        Returns
+        -------
+        list of the tuples (modality, location) indexed for `window_id`
+        """
+        with self._lock:
+            rows = self._db.execute(
+                    "SELECT modality, location FROM windows "
+                    "WHERE window_id = ? ORDER BY modality, location",
+                    (str(window_id),)).fetchall()
+        return [(modality, location or None) for modality, location in rows]
+
+    def get(self, window_id, modality, location=None):
+        """
+        Returns
+        -------
+        the window as a pandas DataFrame with column Timestamp (seconds since
+        its first row) followed by the sensor columns, like the windows the
+        curation scripts upload, or None if it is not in the index. Windows
+        kept in memory are shared between calls, so do not modify them.
+        """
+        key = (str(window_id), modality, location or "")
+        with self._lock:
+            if key in self._windows:
+                self._windows.move_to_end(key)
+                return self._windows[key]
+            row = self._db.execute(
+                    "SELECT windows.file_id, source_key, float_dtype, "
+                    "start, stop "
+                    "FROM windows JOIN sources USING (file_id) "
+                    "WHERE window_id = ? AND modality = ? AND location = ?",
+                    key).fetchone()
+        if row is None:
+            return None
+        file_id, key_of_source, float_dtype, start, stop = row
+        timestamps, values = self._source(file_id, key_of_source, float_dtype)
+        window = sensor_windows.window_frame(
+                sensor_windows.relative_seconds(
+                    timestamps[start:stop], np.array([0, stop - start])),
+                {c: values[c][start:stop] for c in values},
+                0, stop - start)
+        with self._lock:
+            self._windows[key] = window
+            while len(self._windows) > self.max_windows:
+                self._windows.popitem(last=False)
+        return window
+
+    def _source(self, file_id, key, float_dtype=None):
+        """
+        Returns
+        -------
+        tuple (timestamps, values) of the memory-mapped cache entry of
+        `file_id`, downloading and parsing it should it have been evicted,
+        with values a dict with key sensor column and value its array.
+        Windows are sliced from these arrays, so only their rows are read.
+        """
+        with self._lock:
+            if key in self._sources:
+                self._sources.move_to_end(key)
+                return self._sources[key]
+        entry = self.cache.load_arrays(key)
+        if entry is None:
+            f = sensor_io.SourceFile(self.syn.get(file_id), float_dtype)
+            if sensor_io.source_key(f) != key:
+                raise ValueError("File {} changed since its windows were "
+                                 "indexed, index them again".format(file_id))
+            sensor_io.read_sensor_measurement(f, self.cache)
+            entry = self.cache.load_arrays(key)
+        meta, timestamps, values = entry
+        source = (timestamps, {c["name"]: values[c["name"]]
+                               for c in meta["columns"]
+                               if c["name"] not in sensor_io.ID_COLUMNS})
+        with self._lock:
+            self._sources[key] = source
+            while len(self._sources) > self.max_sources:
+                self._sources.popitem(last=False)
+        return source
+
+    def close(self):
+        with self._lock:
+            self._db.close()